@@ -0,0 +1,259 @@
+"""
+読み込み → 最適化 → 地図出力 パイプラインのベンチマーク。
+
+e-Stat のファイルは不要で、合成した 250m メッシュ (実在のメッシュコード体系) と
+code1.py のダミー候補地/既存店生成を使って、各ステージの処理時間とピークメモリを
+メッシュ数・候補地数のスケールごとに計測する。
+
+使い方:
+    python sample/benchmark.py                          # クイック (1k〜10k メッシュ, 10〜100 候補地)
+    python sample/benchmark.py --full                   # 1k〜1M メッシュ, 10〜10k 候補地
+    python sample/benchmark.py --output results.json    # 結果を JSON で保存
+    python sample/benchmark.py --baseline baseline.json # 基準結果と比較し、劣化があれば終了コード 1
+"""
+import argparse
+import json
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import code1
+import huff_map
+
+# --- 設定値 ---
+QUICK_MESH_SCALES = [1_000, 10_000]
+QUICK_CANDIDATE_SCALES = [10, 100]
+FULL_MESH_SCALES = [1_000, 10_000, 100_000, 1_000_000]
+FULL_CANDIDATE_SCALES = [10, 100, 1_000, 10_000]
+MAP_MAX_MESHES = 50_000        # これより大きいメッシュ数では地図出力ステージを省略する
+REGRESSION_THRESHOLD = 0.25    # 基準比でこの割合以上遅くなったら劣化とみなす
+REGRESSION_MIN_SECONDS = 0.05  # 基準・今回とも この秒数未満のステージは比較しない (計測誤差対策)
+
+# 合成メッシュの南西端 (東京湾岸付近) を 250m メッシュの整数単位 (緯度 1/960 度, 経度 1/640 度) で表す
+SYNTHETIC_ORIGIN_LAT_UNITS = int(35.5 * code1.MESH_LAT_UNITS_PER_DEG)
+SYNTHETIC_ORIGIN_LON_UNITS = int((139.4 - 100) * code1.MESH_LON_UNITS_PER_DEG)
+MESH_250M_UNITS = code1.MESH_SIZE_UNITS_BY_LENGTH[10]
+POP_VALUE_COL = code1.pop_mesh_settings('250m')[1]
+
+
+# --- 合成データ生成 ---
+def encode_250m_mesh_codes(lat_units, lon_units):
+    """南西端の整数単位 (decode_mesh_codes と同じ単位) から 250m メッシュコード (10桁) を作る。"""
+    lat1, lat_rem = np.divmod(lat_units, 640)
+    lon1, lon_rem = np.divmod(lon_units, 640)
+    lat2, lat_rem = np.divmod(lat_rem, 80)
+    lon2, lon_rem = np.divmod(lon_rem, 80)
+    lat3, lat_rem = np.divmod(lat_rem, 8)
+    lon3, lon_rem = np.divmod(lon_rem, 8)
+    half_lat, lat_rem = np.divmod(lat_rem, 4)
+    half_lon, lon_rem = np.divmod(lon_rem, 4)
+    quarter_lat = lat_rem // 2
+    quarter_lon = lon_rem // 2
+    codes = (lat1 * 10**8 + lon1 * 10**6 + lat2 * 10**5 + lon2 * 10**4 + lat3 * 10**3 + lon3 * 10**2
+             + (1 + 2 * half_lat + half_lon) * 10 + (1 + 2 * quarter_lat + quarter_lon))
+    return codes.astype(np.int64).astype(str)
+
+def synthetic_mesh_population(n_meshes, seed=0):
+    """ほぼ正方形に並んだ n_meshes 個の 250m メッシュコードと人口を生成する。"""
+    rng = np.random.default_rng(seed)
+    n_cols = int(np.ceil(np.sqrt(n_meshes)))
+    cell = np.arange(n_meshes)
+    rows, cols = np.divmod(cell, n_cols)
+    mesh_ids = encode_250m_mesh_codes(SYNTHETIC_ORIGIN_LAT_UNITS + rows * MESH_250M_UNITS,
+                                      SYNTHETIC_ORIGIN_LON_UNITS + cols * MESH_250M_UNITS)
+    population = rng.poisson(300, n_meshes).astype(np.float64) + 1
+    return mesh_ids, population
+
+def write_synthetic_estat_files(directory, mesh_ids, population):
+    """e-Stat と同じ形式 (2行ヘッダー, cp932) のテキストファイルを1次メッシュごとに書き出す。"""
+    directory.mkdir(parents=True, exist_ok=True)
+    frame = pd.DataFrame({'KEY_CODE': mesh_ids, 'HTKSYORI': 0, 'HTKSAKI': '', 'GASSAN': '',
+                          POP_VALUE_COL: population.astype(np.int64)})
+    first_level = frame['KEY_CODE'].str[:4]
+    for code, part in frame.groupby(first_level):
+        path = directory / f"tblT001142Q{code}.txt"
+        with open(path, 'w', encoding=code1.POP_CSV_ENCODING, newline='') as f:
+            f.write(','.join(part.columns) + '\n')
+            f.write(',,,,人口（総数）\n')
+            part.to_csv(f, header=False, index=False)
+
+
+# --- 計測 ---
+class StageTimer:
+    """ステージごとの経過時間とピークメモリ (tracemalloc) を記録する。"""
+    def __init__(self, track_memory=True):
+        self.track_memory = track_memory
+        self.results = []
+
+    def run(self, stage, params, func, *args, **kwargs):
+        if self.track_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            value = func(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - start
+            peak_bytes = None
+            if self.track_memory:
+                _, peak_bytes = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+        self.results.append({'stage': stage, **params, 'seconds': seconds, 'peak_bytes': peak_bytes})
+        peak_text = f", peak {peak_bytes / 2**20:,.1f} MB" if peak_bytes is not None else ""
+        param_text = ', '.join(f"{k}={v:,}" for k, v in params.items())
+        print(f"  {stage:<10} [{param_text}] {seconds:8.3f} s{peak_text}")
+        return value
+
+def _silently(func, *args, **kwargs):
+    """code1 の進捗表示を抑えて実行する。"""
+    import contextlib
+    import io
+    with contextlib.redirect_stdout(io.StringIO()):
+        return func(*args, **kwargs)
+
+def _build_demand_mesh(mesh_ids, population):
+    """ジオメトリ生成ステージ: デコード → 四隅の投影 → 重心 → GeoDataFrame。"""
+    lat_sw, lon_sw, lat_ne, lon_ne, valid = code1.decode_mesh_codes(mesh_ids)
+    corner_xy = code1.mesh_corners_projected(lat_sw[valid], lon_sw[valid], lat_ne[valid], lon_ne[valid],
+                                             code1.TARGET_CRS_GEOGRAPHIC, code1.TARGET_CRS_PROJECTED)
+    center_xy = code1.quad_centroids(corner_xy)
+    return code1._build_demand_mesh_gdf(mesh_ids[valid], population[valid], corner_xy, center_xy,
+                                        code1.TARGET_CRS_PROJECTED)
+
+def _render_map(demand_mesh_gdf, capture_df, stores_gdf, output_path, mode):
+    result_map = huff_map.create_choropleth_map_folium(demand_mesh_gdf, capture_df, stores_gdf,
+                                                       target_crs_geo=code1.TARGET_CRS_GEOGRAPHIC, mode=mode,
+                                                       tile_dir=output_path.with_name(output_path.stem + '_tiles'))
+    result_map.save(str(output_path))
+
+def run_benchmarks(mesh_scales, candidate_scales, n_new_stores, greedy_method, track_memory, map_max_meshes, seed,
+                   map_mode='geojson'):
+    timer = StageTimer(track_memory=track_memory)
+    with tempfile.TemporaryDirectory(prefix='huff_bench_') as tmp:
+        tmp_dir = Path(tmp)
+        for n_meshes in mesh_scales:
+            print(f"\n[{n_meshes:,} meshes]")
+            params = {'n_meshes': n_meshes}
+            mesh_ids, population = synthetic_mesh_population(n_meshes, seed=seed)
+            data_dir = tmp_dir / f"estat_{n_meshes}"
+            write_synthetic_estat_files(data_dir, mesh_ids, population)
+            txt_files = sorted(data_dir.glob('*.txt'))
+
+            pop_df = timer.run('loading', params, _silently, code1._read_population_table, txt_files,
+                               code1.POP_MESH_COL, POP_VALUE_COL, code1.POP_CSV_ENCODING,
+                               code1.CSV_HEADER_ROW, streaming=True)
+            demand_mesh_gdf = timer.run('geometry', params, _build_demand_mesh,
+                                        pop_df['mesh_id'].to_numpy(dtype=str),
+                                        pop_df['population'].to_numpy(dtype=np.float64))
+            spatial_index = timer.run('index', params, code1.MeshSpatialIndex.from_mesh, demand_mesh_gdf,
+                                      cell_size=code1.MAX_DISTANCE_M)
+
+            np.random.seed(seed)
+            candidates_gdf, existing_stores_gdf = _silently(
+                code1.generate_dummy_sites, demand_mesh_gdf.total_bounds, max(candidate_scales),
+                code1.N_EXISTING_SELF, code1.N_EXISTING_COMP, code1.TARGET_CRS_PROJECTED
+            )
+            stores_for_calc = existing_stores_gdf.rename(columns={'id': 'store_id'})
+            capture_df, _ = timer.run('capture', params, code1.calculate_demand_capture, demand_mesh_gdf,
+                                      stores_for_calc, code1.DISTANCE_DECAY, code1.MAX_DISTANCE_M,
+                                      spatial_index=spatial_index, as_result=True)
+
+            selected_gdf = None
+            for n_candidates in candidate_scales:
+                selected_gdf, _ = timer.run(
+                    'greedy', {**params, 'n_candidates': n_candidates}, _silently,
+                    code1.greedy_new_store_selection, candidates_gdf.iloc[:n_candidates], demand_mesh_gdf,
+                    existing_stores_gdf, n_new_stores, code1.DISTANCE_DECAY, code1.MAX_DISTANCE_M,
+                    code1.MIN_DEMAND_PER_STORE, spatial_index=spatial_index, method=greedy_method
+                )
+
+            if n_meshes <= map_max_meshes:
+                all_stores = pd.concat([existing_stores_gdf, selected_gdf], ignore_index=True)
+                all_stores['total_demand'] = np.nan
+                timer.run('map', params, _silently, _render_map, demand_mesh_gdf, capture_df, all_stores,
+                          tmp_dir / f"map_{n_meshes}.html", map_mode)
+            else:
+                print(f"  {'map':<10} skipped (more than {map_max_meshes:,} meshes)")
+    return timer.results
+
+
+# --- 結果の保存と基準比較 ---
+def _result_key(result):
+    return (result['stage'], result.get('n_meshes'), result.get('n_candidates'))
+
+def environment_info():
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+    }
+
+def compare_with_baseline(results, baseline, threshold, min_seconds):
+    """基準結果と比較し、劣化したステージの一覧を返す。"""
+    baseline_by_key = {_result_key(r): r for r in baseline.get('results', [])}
+    regressions = []
+    for result in results:
+        base = baseline_by_key.get(_result_key(result))
+        if base is None or max(base['seconds'], result['seconds']) < min_seconds:
+            continue
+        ratio = result['seconds'] / base['seconds'] if base['seconds'] > 0 else float('inf')
+        if ratio > 1 + threshold:
+            regressions.append({**result, 'baseline_seconds': base['seconds'], 'ratio': ratio})
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the load -> optimize -> map pipeline on synthetic meshes.")
+    parser.add_argument('--full', action='store_true', help="Run the full scale grid (1k-1M meshes, 10-10k candidates).")
+    parser.add_argument('--meshes', type=str, help="Comma separated mesh counts (overrides the preset).")
+    parser.add_argument('--candidates', type=str, help="Comma separated candidate counts (overrides the preset).")
+    parser.add_argument('--new-stores', type=int, default=code1.N_NEW_STORES_GREEDY)
+    parser.add_argument('--greedy-method', default=code1.GREEDY_METHOD, choices=['full', 'incremental', 'lazy'])
+    parser.add_argument('--map-max-meshes', type=int, default=MAP_MAX_MESHES)
+    parser.add_argument('--map-mode', default=code1.MAP_EXPORT_MODE, choices=['geojson', 'compact'])
+    parser.add_argument('--no-memory', action='store_true', help="Do not track peak memory (tracemalloc adds overhead).")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', type=Path, help="Write machine-readable results to this JSON file.")
+    parser.add_argument('--baseline', type=Path, help="Compare against a stored baseline JSON file.")
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help="Allowed slowdown ratio over the baseline (0.25 = 25%%).")
+    parser.add_argument('--min-seconds', type=float, default=REGRESSION_MIN_SECONDS)
+    args = parser.parse_args(argv)
+
+    mesh_scales = FULL_MESH_SCALES if args.full else QUICK_MESH_SCALES
+    candidate_scales = FULL_CANDIDATE_SCALES if args.full else QUICK_CANDIDATE_SCALES
+    if args.meshes:
+        mesh_scales = [int(v) for v in args.meshes.split(',')]
+    if args.candidates:
+        candidate_scales = [int(v) for v in args.candidates.split(',')]
+
+    print(f"Benchmarking meshes={mesh_scales}, candidates={candidate_scales}, greedy method={args.greedy_method}")
+    results = run_benchmarks(mesh_scales, candidate_scales, args.new_stores, args.greedy_method,
+                             not args.no_memory, args.map_max_meshes, args.seed, map_mode=args.map_mode)
+    report = {'environment': environment_info(), 'results': results}
+
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2), encoding='utf-8')
+        print(f"\nResults written to {args.output}")
+
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text(encoding='utf-8'))
+        regressions = compare_with_baseline(results, baseline, args.threshold, args.min_seconds)
+        if regressions:
+            print(f"\nRegressions against {args.baseline} (threshold {args.threshold:.0%}):")
+            for r in regressions:
+                print(f"  {r['stage']} n_meshes={r.get('n_meshes')} n_candidates={r.get('n_candidates')}: "
+                      f"{r['baseline_seconds']:.3f} s -> {r['seconds']:.3f} s ({r['ratio']:.2f}x)")
+            return 1
+        print(f"\nNo regressions against {args.baseline}.")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
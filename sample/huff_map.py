@@ -0,0 +1,353 @@
+"""
+需要獲得シミュレーションの可視化 (Folium による地図出力)。
+
+code1.py の計算コアから分離した層で、folium / branca / geopandas はこのモジュールを import したときに
+初めて読み込まれる。候補地の評価だけを行うワーカーは code1 だけを import すればよい。
+計算コアとはメッシュ・需要獲得結果の共通部品 (mesh_core) だけを共有し、code1 は import しない。
+"""
+import json
+import math
+from pathlib import Path
+
+import branca
+import folium
+import numpy as np
+import pandas as pd
+from branca.element import MacroElement, Template
+from folium.plugins import FastMarkerCluster, HeatMap
+from pyproj import Transformer
+
+from mesh_core import (MESH_LAT_UNITS_PER_DEG, MESH_LON_UNITS_PER_DEG, MESH_SIZE_UNITS_BY_LENGTH, CaptureResult,
+                       MeshTable, mesh_grid_units)
+
+# --- 設定値 ---
+MAP_CRS_GEOGRAPHIC = "EPSG:4326" # Folium (Leaflet) に渡す緯度経度の座標系 (WGS84)
+MAP_RASTER_MAX_PIXELS = 4_000_000 # 'compact' で引いた表示に使うメッシュ画像の最大画素数
+MAP_TILE_MIN_ZOOM = 13      # 'compact' でメッシュ単位のタイルを表示する最小の拡大率
+CAPTURE_RATIO_BINS = [0, 10, 20, 30, 40, 50, 60, 70, 80, 90, 100]
+CAPTURE_RATIO_OPACITY = 0.7
+
+# --- 1. 地図出力 (メッシュポリゴン) ---
+def create_choropleth_map_folium(demand_mesh_gdf_projected, capture_df, stores_gdf_projected,
+                                 selected_new_stores_gdf_projected=None, target_crs_geo=MAP_CRS_GEOGRAPHIC,
+                                 mode='geojson', tile_dir=None, raster_max_pixels=MAP_RASTER_MAX_PIXELS,
+                                 tile_min_zoom=MAP_TILE_MIN_ZOOM):
+    """
+    投影座標系のデータを入力とし、Folium表示用に地理座標系に変換して地図を作成。
+    mode='compact' の場合はメッシュポリゴンを埋め込まず、create_compact_map_folium で地図を作る
+    (tile_dir にメッシュ単位のタイルを書き出す)。capture_df には CaptureResult も渡せる。
+    """
+    if mode == 'compact':
+        return create_compact_map_folium(demand_mesh_gdf_projected, capture_df, stores_gdf_projected,
+                                         selected_new_stores_gdf_projected, target_crs_geo=target_crs_geo,
+                                         tile_dir=tile_dir, raster_max_pixels=raster_max_pixels,
+                                         tile_min_zoom=tile_min_zoom)
+    if mode != 'geojson':
+        raise ValueError(f"Unknown map export mode: {mode}")
+    if isinstance(demand_mesh_gdf_projected, MeshTable):
+        demand_mesh_gdf_projected = demand_mesh_gdf_projected.to_geodataframe() # ポリゴンはここで初めて作る
+    if demand_mesh_gdf_projected.empty:
+        print("Demand mesh data is empty. Cannot create map.")
+        return None
+
+    # 1. メッシュごとの自チェーン獲得割合を計算 (入力は投影座標系のまま)
+    mesh_self_capture = _mesh_self_capture(capture_df)
+
+    map_gdf_projected = pd.merge(demand_mesh_gdf_projected[['mesh_id', 'geometry', 'population']], mesh_self_capture, on='mesh_id', how='left')
+    map_gdf_projected['captured_demand_self'] = map_gdf_projected['captured_demand'].fillna(0)
+    map_gdf_projected['capture_ratio_self'] = 0.0
+    valid_pop_mask = map_gdf_projected['population'] > 0
+    map_gdf_projected.loc[valid_pop_mask, 'capture_ratio_self'] = (map_gdf_projected.loc[valid_pop_mask, 'captured_demand_self'] / map_gdf_projected.loc[valid_pop_mask, 'population']).clip(0, 1) * 100
+
+    # --- Folium表示用に地理座標系に変換 ---
+    map_gdf_geo = map_gdf_projected.to_crs(target_crs_geo)
+    stores_gdf_geo = stores_gdf_projected.to_crs(target_crs_geo)
+    if selected_new_stores_gdf_projected is not None and not selected_new_stores_gdf_projected.empty:
+        selected_new_stores_gdf_geo = selected_new_stores_gdf_projected.to_crs(target_crs_geo)
+    else:
+        selected_new_stores_gdf_geo = None
+    # --- ここまで変換 ---
+
+    # 2. 地図の作成 (Folium)
+    # 中心は全メッシュの外接矩形の中心 (unary_union はメッシュ数が多いと重い)
+    min_lon, min_lat, max_lon, max_lat = map_gdf_geo.total_bounds
+    center_lat, center_lon = (min_lat + max_lat) / 2, (min_lon + max_lon) / 2
+    m = folium.Map(location=[center_lat, center_lon], zoom_start=12, tiles='cartodbpositron') # タイルも変更可能
+
+    # 3. Choropleth レイヤー
+    folium.Choropleth(
+        geo_data=map_gdf_geo.to_json(),
+        name='Self Chain Capture Ratio (%)',
+        data=map_gdf_geo, # Foliumには地理座標系のデータを渡す
+        columns=['mesh_id', 'capture_ratio_self'],
+        key_on='feature.properties.mesh_id',
+        fill_color='Blues',
+        fill_opacity=CAPTURE_RATIO_OPACITY,
+        line_opacity=0.2,
+        legend_name='Self Chain Demand Capture Ratio (%)',
+        bins=CAPTURE_RATIO_BINS
+    ).add_to(m)
+
+    # 4. 店舗マーカー (地理座標系のデータを使用)
+    _add_store_marker_layers(m, stores_gdf_geo, selected_new_stores_gdf_geo)
+
+    folium.LayerControl().add_to(m)
+    return m
+
+def _add_store_marker_layers(m, stores_gdf_geo, selected_new_stores_gdf_geo=None):
+    """店舗マーカーを種別ごとのクラスタレイヤー (FastMarkerCluster) としてまとめて追加する。"""
+    layers = [
+        ('Existing Self Stores', 'Existing Self', stores_gdf_geo[stores_gdf_geo['type'] == 'self'], 'blue', 'shop'),
+        ('Competitor Stores', 'Competitor', stores_gdf_geo[stores_gdf_geo['type'] == 'comp'], 'red', 'shop'),
+    ]
+    if selected_new_stores_gdf_geo is not None and not selected_new_stores_gdf_geo.empty:
+        layers.append(('Newly Selected Stores', 'Newly Selected', selected_new_stores_gdf_geo, 'green', 'star'))
+
+    callback = """
+    function (row) {
+        var icon = L.AwesomeMarkers.icon({icon: row[4], markerColor: row[3], prefix: 'glyphicon'});
+        return L.marker(new L.LatLng(row[0], row[1]), {icon: icon}).bindPopup(row[2]);
+    }
+    """
+    for layer_name, label, stores, color, icon in layers:
+        if stores.empty:
+            continue
+        demand = stores['total_demand'] if 'total_demand' in stores.columns else pd.Series('N/A', index=stores.index)
+        rows = [[lat, lon, f"{label}: {store_id}<br>Demand: {value}", color, icon]
+                for lat, lon, store_id, value in zip(stores.geometry.y, stores.geometry.x, stores['id'], demand)]
+        FastMarkerCluster(rows, callback=callback, name=layer_name).add_to(m)
+
+# --- 2. 大規模メッシュ向けの地図出力 (ラスタ + タイル分割) ---
+MAP_TILE_INDEX_FILE = 'index.json'
+
+def _mesh_self_capture(capture):
+    """capture_df または CaptureResult から、メッシュごとの自チェーン獲得需要 (mesh_id, captured_demand) を作る。"""
+    if isinstance(capture, CaptureResult):
+        return capture.mesh_self_capture()
+    self_capture = capture[capture['store_type'] == 'self']
+    return self_capture.groupby('mesh_id')['captured_demand'].sum().reset_index()
+
+def _mesh_self_capture_ratio(demand_mesh_gdf, capture_df):
+    """メッシュごとの自チェーン獲得割合 (%, 0〜100) を demand_mesh_gdf の行順で返す。"""
+    if isinstance(capture_df, CaptureResult) and len(capture_df.mesh_ids) == len(demand_mesh_gdf):
+        captured = capture_df.mesh_totals('self') # メッシュ順の配列をそのまま使う
+    else:
+        captured = _mesh_self_capture(capture_df).set_index('mesh_id')['captured_demand']
+        captured = captured.reindex(demand_mesh_gdf['mesh_id']).fillna(0).to_numpy(dtype=np.float64)
+    population = demand_mesh_gdf['population'].to_numpy(dtype=np.float64)
+    ratio = np.divide(captured, population, out=np.zeros_like(population), where=population > 0)
+    return np.clip(ratio, 0, 1) * 100
+
+def _capture_ratio_colormap():
+    """CAPTURE_RATIO_BINS の階級ごとの色 (Choropleth の 'Blues' と同系統) と凡例用の StepColormap。"""
+    colormap = branca.colormap.linear.Blues_09.to_step(index=CAPTURE_RATIO_BINS)
+    colormap.caption = 'Self Chain Demand Capture Ratio (%)'
+    mids = [(lo + hi) / 2 for lo, hi in zip(CAPTURE_RATIO_BINS[:-1], CAPTURE_RATIO_BINS[1:])]
+    lut = np.array([colormap.rgba_bytes_tuple(v) for v in mids], dtype=np.uint8)
+    return colormap, lut
+
+def mesh_capture_raster(lat_units, lon_units, size_units, ratio, population, max_pixels):
+    """
+    メッシュの獲得割合をグリッド (緯度経度) 上の RGBA 画像にする。
+    画素数が max_pixels を超える場合は複数メッシュを1画素にまとめ、人口加重平均の割合で塗る。
+    返り値: (rgba (H, W, 4) uint8, 北が上, [[south, west], [north, east]])
+    """
+    cell = int(size_units.min())
+    lat0, lon0 = int(lat_units.min()), int(lon_units.min())
+    n_rows = int((lat_units + size_units).max() - lat0 + cell - 1) // cell
+    n_cols = int((lon_units + size_units).max() - lon0 + cell - 1) // cell
+    factor = max(1, math.ceil(math.sqrt(n_rows * n_cols / max_pixels)))
+    pixel = cell * factor
+    height, width = -(-n_rows // factor), -(-n_cols // factor)
+
+    pixel_idx = ((lat_units - lat0) // pixel) * width + (lon_units - lon0) // pixel
+    weight = np.where(population > 0, population, 1.0) # 人口 0 のメッシュも割合 0 として塗る
+    weighted = np.bincount(pixel_idx, weights=ratio * weight, minlength=height * width)
+    total = np.bincount(pixel_idx, weights=weight, minlength=height * width)
+    filled = total > 0
+    pixel_ratio = np.divide(weighted, total, out=np.zeros_like(total), where=filled)
+
+    _, lut = _capture_ratio_colormap()
+    bins = np.clip(np.searchsorted(CAPTURE_RATIO_BINS, pixel_ratio, side='right') - 1, 0, len(lut) - 1)
+    rgba = lut[bins]
+    rgba[:, 3] = np.where(filled, int(255 * CAPTURE_RATIO_OPACITY), 0)
+    rgba = rgba.reshape(height, width, 4)[::-1] # 行 0 が北になるように反転
+
+    south, west = lat0 / MESH_LAT_UNITS_PER_DEG, lon0 / MESH_LON_UNITS_PER_DEG + 100
+    north, east = (lat0 + height * pixel) / MESH_LAT_UNITS_PER_DEG, (lon0 + width * pixel) / MESH_LON_UNITS_PER_DEG + 100
+    return rgba, [[south, west], [north, east]]
+
+def _mercator_rows(rgba, bounds):
+    """緯度等間隔の画像を Web メルカトルの行位置に並べ替える (最近傍)。"""
+    (south, _), (north, _) = bounds
+    height = rgba.shape[0]
+    mercator = lambda lat: np.arcsinh(np.tan(np.radians(lat)))
+    y = np.linspace(mercator(north), mercator(south), height, endpoint=False) \
+        - (mercator(north) - mercator(south)) / (2 * height)
+    lat = np.degrees(np.arctan(np.sinh(y)))
+    src_rows = np.clip(((north - lat) / (north - south) * height).astype(np.int64), 0, height - 1)
+    return rgba[src_rows]
+
+def write_mesh_capture_tiles(tile_dir, mesh_ids, lat_units, lon_units, size_units, ratio, population):
+    """
+    メッシュごとの獲得割合を1次メッシュ単位のタイル (JSON) に書き出す。
+    座標はタイル南西端からの整数オフセット、割合は 0〜255 に量子化して保存する。
+    tile_dir/index.json に各タイルのファイル名と範囲 [south, west, north, east] を書く。
+    """
+    tile_dir = Path(tile_dir)
+    tile_dir.mkdir(parents=True, exist_ok=True)
+    first_level = np.array([code[:4] for code in mesh_ids])
+    quantized = np.rint(ratio * 2.55).astype(np.uint8)
+    index = {'lat_units_per_deg': MESH_LAT_UNITS_PER_DEG, 'lon_units_per_deg': MESH_LON_UNITS_PER_DEG,
+             'lon_origin': 100, 'ratio_scale': 2.55, 'tiles': []}
+    order = np.argsort(first_level, kind='stable')
+    codes, starts = np.unique(first_level[order], return_index=True)
+    for code, part in zip(codes, np.split(order, starts[1:])):
+        lat0 = int(lat_units[part].min()) // MESH_SIZE_UNITS_BY_LENGTH[4] * MESH_SIZE_UNITS_BY_LENGTH[4]
+        lon0 = int(lon_units[part].min()) // MESH_SIZE_UNITS_BY_LENGTH[4] * MESH_SIZE_UNITS_BY_LENGTH[4]
+        tile = {
+            'code': str(code), 'lat0': lat0, 'lon0': lon0,
+            'id': mesh_ids[part].tolist(),
+            'r': (lat_units[part] - lat0).tolist(), 'c': (lon_units[part] - lon0).tolist(),
+            's': size_units[part].tolist(), 'v': quantized[part].tolist(),
+            'p': np.rint(population[part]).astype(np.int64).tolist(),
+        }
+        file_name = f"{code}.json"
+        (tile_dir / file_name).write_text(json.dumps(tile, separators=(',', ':')), encoding='utf-8')
+        size = MESH_SIZE_UNITS_BY_LENGTH[4]
+        index['tiles'].append({'code': str(code), 'file': file_name, 'bounds': [
+            lat0 / MESH_LAT_UNITS_PER_DEG, lon0 / MESH_LON_UNITS_PER_DEG + 100,
+            (lat0 + size) / MESH_LAT_UNITS_PER_DEG, (lon0 + size) / MESH_LON_UNITS_PER_DEG + 100]})
+    (tile_dir / MAP_TILE_INDEX_FILE).write_text(json.dumps(index, separators=(',', ':')), encoding='utf-8')
+    return len(index['tiles'])
+
+class MeshTileLayer(MacroElement):
+    """
+    拡大率が min_zoom 以上のとき、表示範囲にかかるタイル (write_mesh_capture_tiles の出力) を読み込み、
+    メッシュを canvas に描画する。それより引いた表示では raster_layer (ImageOverlay) を表示する。
+    タイルは HTML からの相対パス base_url で読み込むため、HTTP サーバ経由で開く必要がある。
+    """
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        (function () {
+            var map = {{ this._parent.get_name() }};
+            var raster = {{ this.raster_layer.get_name() }};
+            var base = {{ this.base_url|tojson }};
+            var colors = {{ this.colors|tojson }};
+            var minZoom = {{ this.min_zoom }};
+            var renderer = L.canvas({padding: 0.5});
+            var meshes = L.layerGroup();
+            var loaded = {};
+            var index = null;
+
+            function draw(tile) {
+                for (var i = 0; i < tile.r.length; i++) {
+                    var south = (tile.lat0 + tile.r[i]) / index.lat_units_per_deg;
+                    var west = (tile.lon0 + tile.c[i]) / index.lon_units_per_deg + index.lon_origin;
+                    var ratio = tile.v[i] / index.ratio_scale;
+                    var color = colors[Math.min(Math.floor(ratio / 10), colors.length - 1)];
+                    L.rectangle([[south, west], [south + tile.s[i] / index.lat_units_per_deg,
+                                                 west + tile.s[i] / index.lon_units_per_deg]],
+                                 {renderer: renderer, stroke: false, fillColor: color,
+                                  fillOpacity: {{ this.opacity }}})
+                        .bindTooltip(tile.id[i] + '<br>Population: ' + tile.p[i] +
+                                     '<br>Capture: ' + ratio.toFixed(1) + '%')
+                        .addTo(meshes);
+                }
+            }
+
+            function update() {
+                if (!index) { return; }
+                if (map.getZoom() < minZoom) {
+                    map.removeLayer(meshes);
+                    raster.addTo(map);
+                    return;
+                }
+                map.removeLayer(raster);
+                meshes.addTo(map);
+                var view = map.getBounds();
+                index.tiles.forEach(function (t) {
+                    if (loaded[t.code] || !view.intersects([[t.bounds[0], t.bounds[1]], [t.bounds[2], t.bounds[3]]])) {
+                        return;
+                    }
+                    loaded[t.code] = true;
+                    fetch(base + '/' + t.file).then(function (r) { return r.json(); }).then(draw);
+                });
+            }
+
+            fetch(base + '/{{ this.index_file }}')
+                .then(function (r) { return r.json(); })
+                .then(function (data) { index = data; update(); });
+            map.on('moveend', update);
+        })();
+        {% endmacro %}
+    """)
+
+    def __init__(self, raster_layer, base_url, colors, min_zoom, opacity=CAPTURE_RATIO_OPACITY):
+        super().__init__()
+        self._name = 'MeshTileLayer'
+        self.raster_layer = raster_layer
+        self.base_url = base_url
+        self.colors = colors
+        self.min_zoom = min_zoom
+        self.opacity = opacity
+        self.index_file = MAP_TILE_INDEX_FILE
+
+def create_compact_map_folium(demand_mesh_gdf_projected, capture_df, stores_gdf_projected,
+                              selected_new_stores_gdf_projected=None, target_crs_geo=MAP_CRS_GEOGRAPHIC, tile_dir=None,
+                              raster_max_pixels=MAP_RASTER_MAX_PIXELS, tile_min_zoom=MAP_TILE_MIN_ZOOM):
+    """
+    メッシュポリゴンを HTML に埋め込まない地図を作る。
+    - 引いた表示: メッシュグリッドを画素数 raster_max_pixels 以下の画像 (ImageOverlay) として表示
+    - 拡大時 (tile_min_zoom 以上): tile_dir に書き出した1次メッシュ単位の量子化タイルを表示範囲の分だけ読み込む
+    - 店舗: 種別ごとのクラスタレイヤー
+    HTML の大きさはメッシュ数によらずほぼ一定になる。tile_dir は HTML と同じディレクトリに置くこと。
+    """
+    if demand_mesh_gdf_projected.empty:
+        print("Demand mesh data is empty. Cannot create map.")
+        return None
+
+    mesh_ids = demand_mesh_gdf_projected['mesh_id'].to_numpy(dtype=str)
+    ratio = _mesh_self_capture_ratio(demand_mesh_gdf_projected, capture_df)
+    population = demand_mesh_gdf_projected['population'].to_numpy(dtype=np.float64)
+    lat_units, lon_units, size_units, valid = mesh_grid_units(mesh_ids)
+    if not valid.all():
+        print(f"  Warning: {int((~valid).sum())} meshes have invalid mesh codes and are not drawn.")
+        mesh_ids, ratio, population = mesh_ids[valid], ratio[valid], population[valid]
+        lat_units, lon_units, size_units = lat_units[valid], lon_units[valid], size_units[valid]
+
+    rgba, bounds = mesh_capture_raster(lat_units, lon_units, size_units, ratio, population, raster_max_pixels)
+    (south, west), (north, east) = bounds
+    m = folium.Map(location=[(south + north) / 2, (west + east) / 2], zoom_start=12, tiles='cartodbpositron')
+
+    raster = folium.raster_layers.ImageOverlay(
+        _mercator_rows(rgba, bounds), bounds=bounds, name='Self Chain Capture Ratio (%)', pixelated=True
+    )
+    raster.add_to(m)
+    colormap, lut = _capture_ratio_colormap()
+    colormap.add_to(m)
+    print(f"  Mesh raster: {rgba.shape[1]} x {rgba.shape[0]} px for {len(mesh_ids):,} meshes.")
+
+    if tile_dir is not None:
+        n_tiles = write_mesh_capture_tiles(tile_dir, mesh_ids, lat_units, lon_units, size_units, ratio, population)
+        colors = ['#{:02x}{:02x}{:02x}'.format(*rgb) for rgb in lut[:, :3]]
+        MeshTileLayer(raster, Path(tile_dir).name, colors, tile_min_zoom).add_to(m)
+        print(f"  Wrote {n_tiles} mesh tiles to {tile_dir} (shown from zoom {tile_min_zoom}; open the map over HTTP).")
+
+    stores_gdf_geo = stores_gdf_projected.to_crs(target_crs_geo)
+    selected_geo = None
+    if selected_new_stores_gdf_projected is not None and not selected_new_stores_gdf_projected.empty:
+        selected_geo = selected_new_stores_gdf_projected.to_crs(target_crs_geo)
+    _add_store_marker_layers(m, stores_gdf_geo, selected_geo)
+
+    folium.LayerControl().add_to(m)
+    return m
+
+# --- 3. 増分サーフェスのヒートマップ ---
+def gain_heat_layer(gain_df, target_projected_crs, target_crs_geo=MAP_CRS_GEOGRAPHIC, max_points=20_000):
+    """増分サーフェスの上位 max_points セルを Folium の HeatMap レイヤーにする。"""
+    top = gain_df.head(max_points)
+    transformer = Transformer.from_crs(target_projected_crs, target_crs_geo, always_xy=True)
+    lon, lat = transformer.transform(top['x'].to_numpy(), top['y'].to_numpy())
+    weight = top['gain'].to_numpy() / top['gain'].max() if len(top) and top['gain'].max() > 0 else top['gain'].to_numpy()
+    return HeatMap(np.column_stack([lat, lon, weight]).tolist(), name='New Store Gain (heat)', radius=12, blur=15)
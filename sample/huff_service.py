@@ -0,0 +1,562 @@
+"""
+what-if 評価用の常駐 HTTP サービス。
+
+需要メッシュ・候補地・既存店舗と空間インデックスを起動時に1回だけ読み込み (code1.load_simulation_inputs)、
+メッシュごとの引力合計 (HuffAttractionState) と店舗ごとの半径内メッシュを保持したまま、
+「この地点に出したら」「この店を閉めたら」といった問い合わせに答える。計算はスレッドプールで行い、
+イベントループ (asyncio) は HTTP の読み書きだけを受け持つ。
+
+- POST /score     {"sites": [{"x", "y"} または {"lon", "lat"}, "attractiveness"?, "type"?]}
+                  現在の店舗集合に各地点を1店だけ加えたときの、その店舗自身の獲得需要と自チェーン獲得需要の増減
+                  (店舗集合は変えない)。単一地点なら半径内メッシュだけで計算する。
+- POST /evaluate  {"stores": [...]}  指定した店舗集合だけで店舗別需要を計算する (店舗集合は変えない)。
+- POST /stores/add     {"stores": [...]}  店舗を追加し、店舗別需要とその増減を返す。
+- POST /stores/remove  {"ids": [...]}     店舗を外し、店舗別需要とその増減を返す。
+- POST /greedy    {"n_new_stores"?, "min_demand_per_store"?, "commit"?}  現在の店舗集合から候補地を遅延評価版の
+                  貪欲法で選ぶ。commit=true なら選んだ店舗を店舗集合に加える。
+- GET  /stores  現在の店舗別需要、GET /stats  ルートごとの処理時間 (p50 / p95)、GET /health  死活確認。
+
+店舗集合の更新は配列を複製して新しいスナップショットに差し替えるので、評価系の問い合わせはロックを取らない。
+外部サービスは不要で、--synthetic-meshes で合成メッシュ (benchmark.py) を使えば e-Stat のファイルも要らない。
+
+使い方:
+    python huff_service.py                                      # SimulationConfig の既定値で読み込んで待ち受ける
+    python huff_service.py --synthetic-meshes 100000            # 合成メッシュで起動
+    python huff_service.py --synthetic-meshes 100000 --self-test 1000   # 単一地点スコアの p50 / p95 を計測して終了
+"""
+import argparse
+import asyncio
+import json
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from pathlib import Path
+
+import numpy as np
+import pyproj
+
+from code1 import (DEFAULT_ATTRACTIVENESS, N_NEW_STORES_GREEDY, CandidateNeighbourhood, HuffAttractionState,
+                   SimulationConfig, _mesh_arrays, _run_lazy_steps, _store_arrays, load_simulation_inputs)
+
+# --- 設定値 ---
+SERVICE_HOST = '127.0.0.1'
+SERVICE_PORT = 8765
+SERVICE_WORKERS = 4               # 計算用スレッド数 (同時に処理する問い合わせ数)
+SERVICE_MAX_BODY_BYTES = 1024**2  # リクエストボディの上限
+SERVICE_LATENCY_WINDOW = 1000     # /stats の p50 / p95 に使う直近の処理時間の件数 (ルートごと)
+SERVICE_TARGET_P95_MS = 100       # --self-test で単一地点スコアの p95 がこれを超えたら終了コード 1
+STORE_TYPES = ('self', 'comp')
+
+
+class _StoreSet:
+    """
+    店舗集合のスナップショット。店舗ごとの半径内メッシュと引力 (rows) と、それを集計したメッシュ状態を持つ。
+    作成後は変更しない (追加・削除は新しいスナップショットを作る)。
+    """
+    __slots__ = ('ids', 'types', 'xy', 'attractiveness', 'rows', 'state')
+
+    def __init__(self, ids, types, xy, attractiveness, rows, state):
+        self.ids = ids
+        self.types = types
+        self.xy = xy
+        self.attractiveness = attractiveness
+        self.rows = rows
+        self.state = state
+
+    def store_totals(self):
+        """店舗ごとの獲得需要 (半径内メッシュの 人口 × 引力 / 引力合計 の和)。"""
+        total = self.state.total_attraction
+        pop = self.state.mesh_pop
+        return np.array([float(np.dot(pop[mesh_idx], attraction / total[mesh_idx]))
+                         for mesh_idx, attraction in self.rows])
+
+    def to_dict(self, previous=None):
+        """店舗別需要の JSON 用 dict。previous (店舗 ID → 需要) を渡すと増減 (delta) も含める。"""
+        stores = []
+        for store_id, store_type, demand in zip(self.ids, self.types, self.store_totals()):
+            row = {'id': store_id, 'type': store_type, 'total_demand': demand}
+            if previous is not None:
+                row['delta'] = demand - previous.get(store_id, 0.0)
+            stores.append(row)
+        result = {'self_demand': self.state.self_demand(), 'n_stores': len(self.ids), 'stores': stores}
+        if previous is not None:
+            result['removed'] = sorted(set(previous) - set(self.ids))
+        return result
+
+
+class WhatIfModel:
+    """
+    常駐サービスが保持するモデル。需要メッシュ・空間インデックス・候補地の近傍は起動時に作り、
+    店舗集合は _StoreSet のスナップショットとして差し替える。評価系のメソッドはどのスレッドから呼んでもよい。
+    """
+    def __init__(self, demand_mesh_gdf, existing_stores_gdf, candidates_gdf, spatial_index, distance_decay,
+                 max_distance, target_crs_geographic, target_crs_projected,
+                 new_store_attractiveness=DEFAULT_ATTRACTIVENESS):
+        self.mesh_xy, self.mesh_pop = _mesh_arrays(demand_mesh_gdf)
+        if spatial_index.n_meshes != len(self.mesh_pop):
+            raise ValueError("spatial_index was built for a different demand mesh (mesh count mismatch).")
+        self.spatial_index = spatial_index
+        self.distance_decay = float(distance_decay)
+        self.max_distance = float(max_distance)
+        self.new_store_attractiveness = float(new_store_attractiveness) # 候補地・魅力度を省略した地点の魅力度
+        self.target_crs_geographic = target_crs_geographic
+        self.target_crs_projected = target_crs_projected
+        self._local = threading.local() # pyproj の Transformer はスレッドごとに作る
+        self._write_lock = threading.Lock()
+        self._n_generated = 0
+
+        self.candidates_gdf = candidates_gdf.reset_index(drop=True)
+        candidate_xy = np.column_stack([self.candidates_gdf.geometry.x.to_numpy(dtype=np.float64),
+                                        self.candidates_gdf.geometry.y.to_numpy(dtype=np.float64)])
+        self.candidates = CandidateNeighbourhood.build(
+            spatial_index, candidate_xy, np.full(len(candidate_xy), self.new_store_attractiveness), self.distance_decay,
+            self.max_distance
+        )
+
+        if existing_stores_gdf.empty:
+            store_xy, store_attr = np.empty((0, 2)), np.empty(0)
+        else:
+            store_xy, store_attr = _store_arrays(existing_stores_gdf)
+        self.stores = self._build_store_set(existing_stores_gdf['id'].astype(str).tolist(),
+                                            existing_stores_gdf['type'].tolist(), store_xy, store_attr)
+
+    @classmethod
+    def from_config(cls, config):
+        """SimulationConfig の設定でデータを読み込んでモデルを作る。"""
+        candidates_gdf, demand_mesh_gdf, existing_stores_gdf, spatial_index = load_simulation_inputs(config)
+        return cls(demand_mesh_gdf, existing_stores_gdf, candidates_gdf, spatial_index, config.distance_decay,
+                   config.cutoff, config.target_crs_geographic, config.target_crs_projected,
+                   new_store_attractiveness=config.new_store_attractiveness)
+
+    @property
+    def n_meshes(self):
+        return len(self.mesh_pop)
+
+    # --- 入力の検証・変換 ---
+    def _to_projected(self, lon, lat):
+        transformer = getattr(self._local, 'transformer', None)
+        if transformer is None:
+            transformer = pyproj.Transformer.from_crs(self.target_crs_geographic, self.target_crs_projected,
+                                                      always_xy=True)
+            self._local.transformer = transformer
+        return transformer.transform(lon, lat)
+
+    def _parse_sites(self, sites, default_type='self'):
+        """
+        地点の dict のリストを (ids, types, xy (M, 2), attractiveness (M,)) にする。
+        座標は投影座標 (x, y) か緯度経度 (lon, lat) のどちらかで指定する。
+        """
+        if not isinstance(sites, list) or not sites:
+            raise ValueError("Expected a non-empty list of sites.")
+        ids, types, xy, attr = [], [], [], []
+        for site in sites:
+            if not isinstance(site, dict):
+                raise ValueError(f"Each site must be an object: {site!r}")
+            if 'x' in site and 'y' in site:
+                x, y = float(site['x']), float(site['y'])
+            elif 'lon' in site and 'lat' in site:
+                x, y = self._to_projected(float(site['lon']), float(site['lat']))
+            else:
+                raise ValueError(f"Each site needs either x/y (projected) or lon/lat: {site!r}")
+            store_type = site.get('type', default_type)
+            if store_type not in STORE_TYPES:
+                raise ValueError(f"Site type must be one of {STORE_TYPES}: {store_type!r}")
+            attractiveness = float(site.get('attractiveness', self.new_store_attractiveness))
+            if not attractiveness > 0:
+                raise ValueError(f"Site attractiveness must be positive: {attractiveness!r}")
+            store_id = site.get('id')
+            if store_id is None:
+                with self._write_lock:
+                    self._n_generated += 1
+                    store_id = f"whatif_{self._n_generated}"
+            ids.append(str(store_id))
+            types.append(store_type)
+            xy.append((x, y))
+            attr.append(attractiveness)
+        return ids, types, np.array(xy, dtype=np.float64), np.array(attr, dtype=np.float64)
+
+    # --- 近傍・状態の計算 ---
+    def _site_rows(self, xy, attractiveness):
+        """地点ごとの (半径内メッシュ, 引力) のリスト。"""
+        rows = []
+        for (x, y), attr in zip(xy, attractiveness):
+            mesh_idx, distances = self.spatial_index.query_radius(x, y, self.max_distance)
+            rows.append((mesh_idx, attr / distances ** self.distance_decay))
+        return rows
+
+    def _build_store_set(self, ids, types, xy, attractiveness):
+        if len(set(ids)) != len(ids):
+            raise ValueError("Store ids must be unique.")
+        rows = self._site_rows(xy, attractiveness)
+        state = HuffAttractionState(self.mesh_pop, np.zeros(self.n_meshes), np.zeros(self.n_meshes))
+        for (mesh_idx, attraction), store_type in zip(rows, types):
+            state.add_store(mesh_idx, attraction, is_self=(store_type == 'self'))
+        return _StoreSet(list(ids), list(types), np.asarray(xy, dtype=np.float64).reshape(-1, 2),
+                         np.asarray(attractiveness, dtype=np.float64), rows, state)
+
+    @staticmethod
+    def _site_effect(state, mesh_idx, attraction, is_self):
+        """
+        状態 state に地点の引力を加えたときの (その地点自身の獲得需要, 自チェーン獲得需要の増減)。
+        自チェーン店が他の自チェーン店から奪う分 (共食い) は増減から差し引かれる。
+        """
+        pop = state.mesh_pop[mesh_idx]
+        total = state.total_attraction[mesh_idx]
+        self_attr = state.self_attraction[mesh_idx]
+        new_total = total + attraction
+        own = pop * np.divide(attraction, new_total, out=np.zeros_like(new_total), where=new_total > 0)
+        old_ratio = np.divide(self_attr, total, out=np.zeros_like(total), where=total > 0)
+        new_self = self_attr + attraction if is_self else self_attr
+        new_ratio = np.divide(new_self, new_total, out=np.zeros_like(new_total), where=new_total > 0)
+        return float(own.sum()), float(np.dot(pop, new_ratio - old_ratio))
+
+    # --- 問い合わせ ---
+    def score_sites(self, payload):
+        """各地点を現在の店舗集合に1店だけ加えたときの評価 (店舗集合は変えない)。"""
+        stores = self.stores # 以降はこのスナップショットだけを見る
+        ids, types, xy, attractiveness = self._parse_sites(payload.get('sites'))
+        results = []
+        for store_id, store_type, (mesh_idx, attraction) in zip(ids, types, self._site_rows(xy, attractiveness)):
+            own, self_delta = self._site_effect(stores.state, mesh_idx, attraction, store_type == 'self')
+            results.append({
+                'id': store_id, 'type': store_type, 'own_demand': own, 'self_demand_delta': self_delta,
+                'cannibalised_demand': own - self_delta if store_type == 'self' else -self_delta,
+                'meshes_in_range': int(len(mesh_idx)),
+            })
+        return {'base_self_demand': stores.state.self_demand(), 'sites': results}
+
+    def evaluate(self, payload):
+        """指定した店舗集合だけで店舗別需要を計算する (現在の店舗集合は変えない)。"""
+        ids, types, xy, attractiveness = self._parse_sites(payload.get('stores'))
+        return self._build_store_set(ids, types, xy, attractiveness).to_dict()
+
+    def summary(self, payload=None):
+        return self.stores.to_dict()
+
+    def add_stores(self, payload):
+        """店舗を追加し、店舗別需要と追加前からの増減を返す。"""
+        ids, types, xy, attractiveness = self._parse_sites(payload.get('stores'))
+        rows = self._site_rows(xy, attractiveness)
+        with self._write_lock:
+            current, new_stores = self._add_store_rows(ids, types, xy, attractiveness, rows)
+        return new_stores.to_dict(previous=dict(zip(current.ids, current.store_totals())))
+
+    def _add_store_rows(self, ids, types, xy, attractiveness, rows):
+        """店舗を加えた新しいスナップショットに差し替える。_write_lock を取った状態で呼ぶ。返り値: (追加前, 追加後)。"""
+        current = self.stores
+        duplicated = set(ids) & set(current.ids)
+        if duplicated or len(set(ids)) != len(ids):
+            raise ValueError(f"Store ids already in use: {sorted(duplicated) or ids}")
+        state = HuffAttractionState(self.mesh_pop, current.state.total_attraction.copy(),
+                                    current.state.self_attraction.copy())
+        for (mesh_idx, attraction), store_type in zip(rows, types):
+            state.add_store(mesh_idx, attraction, is_self=(store_type == 'self'))
+        self.stores = _StoreSet(current.ids + ids, current.types + types, np.vstack([current.xy, xy]),
+                                np.concatenate([current.attractiveness, attractiveness]), current.rows + rows,
+                                state)
+        return current, self.stores
+
+    def remove_stores(self, payload):
+        """店舗を外し、店舗別需要と削除前からの増減を返す。"""
+        remove_ids = payload.get('ids')
+        if not isinstance(remove_ids, list) or not remove_ids:
+            raise ValueError("Expected a non-empty list of store ids in 'ids'.")
+        remove_ids = {str(store_id) for store_id in remove_ids}
+        with self._write_lock:
+            current = self.stores
+            unknown = remove_ids - set(current.ids)
+            if unknown:
+                raise ValueError(f"Unknown store ids: {sorted(unknown)}")
+            state = HuffAttractionState(self.mesh_pop, current.state.total_attraction.copy(),
+                                        current.state.self_attraction.copy())
+            keep = []
+            for k, store_id in enumerate(current.ids):
+                if store_id in remove_ids:
+                    mesh_idx, attraction = current.rows[k]
+                    state.remove_store(mesh_idx, attraction, is_self=(current.types[k] == 'self'))
+                else:
+                    keep.append(k)
+            new_stores = _StoreSet([current.ids[k] for k in keep], [current.types[k] for k in keep],
+                                   current.xy[keep], current.attractiveness[keep], [current.rows[k] for k in keep],
+                                   state)
+            self.stores = new_stores
+        return new_stores.to_dict(previous=dict(zip(current.ids, current.store_totals())))
+
+    def greedy(self, payload):
+        """
+        現在の店舗集合を既存店として、候補地から遅延評価版の貪欲法で新店を選ぶ。
+        既に店舗集合にある ID の候補地は除く。commit=true なら選んだ店舗を店舗集合に加える
+        (選択から追加までを _write_lock の中で行うので、その間に他の更新は入らない)。
+        """
+        n_new_stores = int(payload.get('n_new_stores', N_NEW_STORES_GREEDY))
+        min_demand_per_store = float(payload.get('min_demand_per_store', 0))
+        if not payload.get('commit'):
+            return self._select_greedy(self.stores, n_new_stores, min_demand_per_store)[0]
+        with self._write_lock:
+            result, selected_rows, rows = self._select_greedy(self.stores, n_new_stores, min_demand_per_store)
+            if len(selected_rows):
+                ids = selected_rows['id'].astype(str).tolist()
+                xy = np.column_stack([selected_rows.geometry.x.to_numpy(dtype=np.float64),
+                                      selected_rows.geometry.y.to_numpy(dtype=np.float64)])
+                current, new_stores = self._add_store_rows(ids, ['self'] * len(ids), xy,
+                                                           np.full(len(ids), self.new_store_attractiveness), rows)
+        if len(selected_rows):
+            result['stores'] = new_stores.to_dict(previous=dict(zip(current.ids, current.store_totals())))
+        return result
+
+    def _select_greedy(self, stores, n_new_stores, min_demand_per_store):
+        """スナップショット stores に対する貪欲法の選択。返り値: (結果の dict, 選んだ候補地の行, その (半径内メッシュ, 引力))。"""
+        candidate_ids = self.candidates_gdf['id'].astype(str).to_numpy()
+        keep = np.flatnonzero(~np.isin(candidate_ids, stores.ids))
+        candidates = self.candidates
+        if len(keep) < candidates.n_candidates:
+            pair_keep = np.isin(candidates.pair_candidate, keep)
+            position = np.full(candidates.n_candidates, -1, dtype=np.intp)
+            position[keep] = np.arange(len(keep))
+            candidates = CandidateNeighbourhood.from_pairs(position[candidates.pair_candidate[pair_keep]],
+                                                           candidates.mesh_idx[pair_keep],
+                                                           candidates.attraction[pair_keep], len(keep))
+        state = HuffAttractionState(self.mesh_pop, stores.state.total_attraction.copy(),
+                                    stores.state.self_attraction.copy())
+        base_self_demand = state.self_demand()
+        selected = _run_lazy_steps(state, candidates, self.candidates_gdf.iloc[keep].reset_index(drop=True),
+                                   n_new_stores, min_demand_per_store, self.max_distance)
+        selected_rows = self.candidates_gdf.iloc[keep[selected]]
+        rows = [candidates.members(c) for c in selected]
+        result = {'selected': selected_rows['id'].astype(str).tolist(), 'base_self_demand': base_self_demand,
+                  'self_demand': state.self_demand()}
+        return result, selected_rows, rows
+
+
+# --- HTTP サーバ ---
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+async def _read_request(reader):
+    """HTTP/1.1 のリクエストを1件読む。接続が閉じられたら None。返り値: (method, path, headers, body)。"""
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    try:
+        method, target, _ = request_line.decode('latin-1').split()
+    except ValueError:
+        raise ValueError(f"Malformed request line: {request_line!r}") from None
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0))
+    if length > SERVICE_MAX_BODY_BYTES:
+        raise OverflowError(f"Request body of {length} bytes exceeds {SERVICE_MAX_BODY_BYTES} bytes.")
+    body = await reader.readexactly(length) if length else b''
+    return method.upper(), target.split('?', 1)[0], headers, body
+
+def _response_bytes(status, payload, keep_alive):
+    body = json.dumps(payload, default=_json_default).encode('utf-8') if payload is not None else b''
+    head = [f"HTTP/1.1 {status.value} {status.phrase}",
+            "Content-Type: application/json",
+            f"Content-Length: {len(body)}",
+            "Access-Control-Allow-Origin: *", # フロントエンド (別オリジン) から直接呼べるように
+            "Access-Control-Allow-Headers: Content-Type",
+            "Access-Control-Allow-Methods: GET, POST, OPTIONS",
+            f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+    return ('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body
+
+class HuffService:
+    """WhatIfModel を HTTP で公開する。計算は n_workers スレッドのプールで行う。"""
+    def __init__(self, model, n_workers=SERVICE_WORKERS):
+        self.model = model
+        self.n_workers = n_workers
+        self.executor = ThreadPoolExecutor(max_workers=n_workers, thread_name_prefix='huff-service')
+        self.latencies = {}
+        self.routes = {
+            ('GET', '/health'): lambda payload: {'status': 'ok', 'n_meshes': model.n_meshes},
+            ('GET', '/stats'): self.stats,
+            ('GET', '/stores'): model.summary,
+            ('POST', '/score'): model.score_sites,
+            ('POST', '/evaluate'): model.evaluate,
+            ('POST', '/stores/add'): model.add_stores,
+            ('POST', '/stores/remove'): model.remove_stores,
+            ('POST', '/greedy'): model.greedy,
+        }
+
+    def stats(self, payload=None):
+        """ルートごとの処理時間 (ミリ秒) の p50 / p95 / 最大 (直近 SERVICE_LATENCY_WINDOW 件)。"""
+        routes = {}
+        for route, samples in list(self.latencies.items()):
+            values = np.array(samples)
+            routes[route] = {'count': len(values), 'p50_ms': float(np.percentile(values, 50)),
+                             'p95_ms': float(np.percentile(values, 95)), 'max_ms': float(values.max())}
+        return {'workers': self.n_workers, 'n_meshes': self.model.n_meshes, 'n_stores': len(self.model.stores.ids),
+                'n_candidates': self.model.candidates.n_candidates, 'routes': routes}
+
+    async def _dispatch(self, method, path, body):
+        handler = self.routes.get((method, path))
+        if handler is None:
+            known_paths = {route_path for _, route_path in self.routes}
+            status = HTTPStatus.METHOD_NOT_ALLOWED if path in known_paths else HTTPStatus.NOT_FOUND
+            return status, {'error': f"{method} {path} is not supported."}
+        try:
+            payload = json.loads(body) if body else {}
+            if not isinstance(payload, dict):
+                raise ValueError("Request body must be a JSON object.")
+            start = time.perf_counter()
+            result = await asyncio.get_running_loop().run_in_executor(self.executor, handler, payload)
+            self.latencies.setdefault(f"{method} {path}", deque(maxlen=SERVICE_LATENCY_WINDOW)).append(
+                (time.perf_counter() - start) * 1000)
+            return HTTPStatus.OK, result
+        except (ValueError, TypeError, KeyError) as e:
+            return HTTPStatus.BAD_REQUEST, {'error': str(e)}
+        except Exception as e: # サービスは止めずにエラーを返す
+            print(f"Error while handling {method} {path}: {e!r}", file=sys.stderr)
+            return HTTPStatus.INTERNAL_SERVER_ERROR, {'error': f"{type(e).__name__}: {e}"}
+
+    async def handle_connection(self, reader, writer):
+        """1接続分の処理。keep-alive の間は続けてリクエストを読む。"""
+        try:
+            while True:
+                try:
+                    request = await _read_request(reader)
+                except (ValueError, OverflowError) as e:
+                    status = HTTPStatus.REQUEST_ENTITY_TOO_LARGE if isinstance(e, OverflowError) else HTTPStatus.BAD_REQUEST
+                    writer.write(_response_bytes(status, {'error': str(e)}, keep_alive=False))
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                if method == 'OPTIONS': # CORS のプリフライト
+                    status, result = HTTPStatus.NO_CONTENT, None
+                else:
+                    status, result = await self._dispatch(method, path, body)
+                writer.write(_response_bytes(status, result, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host=SERVICE_HOST, port=SERVICE_PORT):
+        """待ち受けを開始して asyncio.Server を返す (port=0 なら空いているポート)。"""
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+# --- ローカルでの確認 ---
+async def request_json(reader, writer, method, path, payload=None):
+    """keep-alive の接続で1件問い合わせて (ステータス, JSON) を返す。"""
+    body = json.dumps(payload).encode('utf-8') if payload is not None else b''
+    writer.write((f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+                  f"Content-Length: {len(body)}\r\n\r\n").encode('latin-1') + body)
+    await writer.drain()
+    status_line = await reader.readline()
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    data = await reader.readexactly(int(headers.get('content-length', 0)))
+    return int(status_line.split()[1]), (json.loads(data) if data else None)
+
+async def self_test(host, port, model, n_requests, concurrency, seed=0):
+    """
+    メッシュの範囲内のランダムな1地点を /score に問い合わせ、クライアント側で計った往復時間の
+    (p50, p95) をミリ秒で返す。concurrency 本の接続から並行に送る。
+    """
+    rng = np.random.default_rng(seed)
+    lo, hi = model.mesh_xy.min(axis=0), model.mesh_xy.max(axis=0)
+    points = rng.uniform(lo, hi, size=(n_requests, 2))
+    latencies = []
+
+    async def client(worker):
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            for x, y in points[worker::concurrency]:
+                start = time.perf_counter()
+                status, result = await request_json(reader, writer, 'POST', '/score',
+                                                    {'sites': [{'x': float(x), 'y': float(y)}]})
+                latencies.append((time.perf_counter() - start) * 1000)
+                if status != HTTPStatus.OK:
+                    raise RuntimeError(f"/score returned {status}: {result}")
+        finally:
+            writer.close()
+
+    await asyncio.gather(*(client(worker) for worker in range(concurrency)))
+    return float(np.percentile(latencies, 50)), float(np.percentile(latencies, 95))
+
+def _synthetic_config(n_meshes, directory, seed):
+    """benchmark.py の合成 250m メッシュを e-Stat 形式で directory に書き出し、それを読む設定を返す。"""
+    import benchmark
+    mesh_ids, population = benchmark.synthetic_mesh_population(n_meshes, seed=seed)
+    benchmark.write_synthetic_estat_files(directory, mesh_ids, population)
+    return SimulationConfig(pop_mesh_level='250m', pop_data_dir=directory, pop_cache_dir=None)
+
+async def serve(model, host, port, n_workers, self_test_requests=0):
+    service = HuffService(model, n_workers=n_workers)
+    server = await service.start(host, port)
+    host, port = server.sockets[0].getsockname()[:2]
+    print(f"What-if service listening on http://{host}:{port} ({model.n_meshes:,} meshes, "
+          f"{len(model.stores.ids)} stores, {model.candidates.n_candidates} candidates, {n_workers} workers).")
+    try:
+        if self_test_requests:
+            p50, p95 = await self_test(host, port, model, self_test_requests, concurrency=n_workers * 2)
+            print(f"Single-site /score over {self_test_requests} requests: p50 {p50:.1f} ms, p95 {p95:.1f} ms "
+                  f"(target p95 < {SERVICE_TARGET_P95_MS} ms).")
+            return p95 <= SERVICE_TARGET_P95_MS
+        async with server:
+            await server.serve_forever()
+    finally:
+        server.close()
+        service.close()
+    return True
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Resident what-if scoring service for the Huff model.")
+    parser.add_argument('--host', default=SERVICE_HOST)
+    parser.add_argument('--port', type=int, default=SERVICE_PORT)
+    parser.add_argument('--workers', type=int, default=SERVICE_WORKERS)
+    parser.add_argument('--mesh-level', default=None, choices=['250m', '1000m'])
+    parser.add_argument('--synthetic-meshes', type=int, default=0,
+                        help="Serve synthetic 250m meshes (from benchmark.py) instead of the e-Stat files.")
+    parser.add_argument('--self-test', type=int, default=0, metavar='N',
+                        help="Send N single-site /score requests, print p50/p95 latency and exit.")
+    parser.add_argument('--new-store-attractiveness', type=float, default=DEFAULT_ATTRACTIVENESS,
+                        help="Attractiveness of candidate sites and of sites posted without one.")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    np.random.seed(args.seed) # ダミー候補地・既存店の生成を再現できるように
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.synthetic_meshes:
+            config = _synthetic_config(args.synthetic_meshes, Path(tmp) / 'estat' / '250mesh', args.seed)
+        else:
+            config = SimulationConfig(pop_mesh_level=args.mesh_level) if args.mesh_level else SimulationConfig()
+        config.new_store_attractiveness = args.new_store_attractiveness
+        print(f"Loading model ({config.pop_mesh_level} mesh data)...")
+        start = time.perf_counter()
+        model = WhatIfModel.from_config(config)
+        print(f"Model loaded in {time.perf_counter() - start:.1f} s.")
+    try:
+        ok = asyncio.run(serve(model, args.host, args.port, args.workers, self_test_requests=args.self_test))
+    except KeyboardInterrupt:
+        ok = True
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
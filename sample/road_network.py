@@ -0,0 +1,293 @@
+"""
+道路ネットワーク上の所要時間によるメッシュ × 店舗の近傍計算。
+
+直線距離 (MeshSpatialIndex) の代わりに、道路グラフ上の所要時間 (秒) を「距離」として使う。
+RoadNetworkIndex は MeshSpatialIndex と同じ n_meshes / query_radius / neighbourhood を持つので、
+calculate_demand_capture・貪欲法・入れ替え法・パラメータスイープ・キャリブレーションの spatial_index に
+そのまま渡せる。その場合 max_distance は所要時間の上限 (秒) として扱われる (MAX_DISTANCE_M の代わり)。
+
+- 道路グラフ: GeoPackage (LineString の道路レイヤー。osmnx の save_graph_geopackage の 'edges' など) または
+  OSM PBF (pyrosm が必要)。線の端点をノードとし、長さと道路種別 (または maxspeed) の速度から所要時間を求める。
+  (交差点で分割済みの線を前提とする。osmnx の edges や pyrosm の get_network(nodes=True) はそうなっている)
+- メッシュ中心・店舗は最寄りノードにスナップし、スナップした直線距離は ROAD_ACCESS_SPEED_KMH で所要時間に加える。
+- 店舗 (候補地) のノードを起点に、逆向きグラフ上で所要時間の上限までの多始点 Dijkstra (scipy.sparse.csgraph) を
+  まとめて解き、ノードごとの行 (半径内メッシュ, 所要時間) を保持する。行は cache_dir に保存し、
+  同じ道路グラフ・需要メッシュ・上限で次回以降も再利用する。
+
+scipy と geopandas (PBF の場合は pyrosm も) が必要。code1.py は道路グラフを指定したときだけこのモジュールを import する。
+"""
+import hashlib
+import json
+import os
+import tempfile
+import time
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from scipy import sparse
+from scipy.sparse import csgraph
+from scipy.spatial import cKDTree
+
+from code1 import NeighbourhoodMatrix, TARGET_CRS_PROJECTED, _mesh_arrays
+
+# --- 設定値 ---
+MAX_TRAVEL_TIME_S = 600           # 所要時間の上限 (秒)。直線距離の MAX_DISTANCE_M の代わり
+ROAD_SPEED_KMH = {                # 道路種別 (OSM の highway) ごとの走行速度 (km/h)。maxspeed があればそちらを使う
+    'motorway': 80, 'motorway_link': 50, 'trunk': 50, 'trunk_link': 40,
+    'primary': 40, 'primary_link': 30, 'secondary': 35, 'secondary_link': 30,
+    'tertiary': 30, 'tertiary_link': 25, 'unclassified': 25, 'residential': 20, 'living_street': 10,
+    'service': 15,
+}
+ROAD_DEFAULT_SPEED_KMH = 20       # 道路種別が不明な区間の速度
+ROAD_ACCESS_SPEED_KMH = 10        # メッシュ中心・店舗から最寄りノードまで (直線) の移動速度
+ROAD_MIN_EDGE_SECONDS = 1e-3      # 長さ 0 の区間も辺として残すための最小所要時間
+ROAD_NODE_DECIMALS = 1            # 端点座標 (メートル) をこの桁数で丸めて同じノードとみなす
+ROAD_DIJKSTRA_BYTES = 256 * 1024**2 # 多始点 Dijkstra で一度に確保する (始点数 × ノード数) 配列の上限
+ROAD_CACHE_FORMAT_VERSION = 1
+
+
+def _edge_speed_kmh(edges):
+    """maxspeed (数値として読めるもの) を優先し、なければ highway の種別から速度を決める。"""
+    speed = pd.Series(np.nan, index=edges.index, dtype=np.float64)
+    if 'maxspeed' in edges.columns:
+        speed = pd.to_numeric(edges['maxspeed'].astype(str).str.extract(r'(\d+(?:\.\d+)?)')[0], errors='coerce')
+    if 'highway' in edges.columns:
+        # osmnx は複数の種別を "['primary', 'secondary']" のような文字列で持つので先頭の種別を使う
+        highway = edges['highway'].astype(str).str.extract(r'([a-z_]+)')[0]
+        speed = speed.fillna(highway.map(ROAD_SPEED_KMH))
+    return speed.fillna(ROAD_DEFAULT_SPEED_KMH).clip(lower=1).to_numpy(dtype=np.float64)
+
+def _edge_direction(edges):
+    """一方通行の向き: 0 = 双方向, 1 = 線の向きのみ, -1 = 線と逆向きのみ。"""
+    if 'oneway' not in edges.columns:
+        return np.zeros(len(edges), dtype=np.int8)
+    oneway = edges['oneway'].astype(str).str.strip().str.lower()
+    return np.select([oneway.isin(['true', 'yes', '1']), oneway == '-1'], [1, -1], 0).astype(np.int8)
+
+def read_road_edges(path, target_projected_crs=TARGET_CRS_PROJECTED, layer=None):
+    """
+    道路の LineString を読み、投影座標系に変換した GeoDataFrame を返す。
+    .pbf は pyrosm で車道ネットワークを抽出し、それ以外 (GeoPackage など) は geopandas で layer を読む
+    (layer を省略した GeoPackage では 'edges' レイヤーがあればそれを使う)。
+    """
+    path = Path(path)
+    if path.suffix.lower() == '.pbf':
+        try:
+            from pyrosm import OSM
+        except ImportError as e:
+            raise ImportError("pyrosm is required to read OSM PBF road networks.") from e
+        _, edges = OSM(str(path)).get_network(network_type='driving', nodes=True) # 交差点で分割された辺
+    else:
+        if layer is None and path.suffix.lower() == '.gpkg':
+            import pyogrio
+            layers = [name for name, _ in pyogrio.list_layers(path)]
+            layer = 'edges' if 'edges' in layers else None
+        edges = gpd.read_file(path, layer=layer)
+    edges = edges[edges.geometry.notna()].explode(index_parts=False)
+    edges = edges[edges.geom_type == 'LineString']
+    if edges.empty:
+        raise ValueError(f"No road LineStrings found in {path}.")
+    return edges.to_crs(target_projected_crs).reset_index(drop=True)
+
+
+class RoadGraph:
+    """
+    道路ネットワークの有向グラフ。ノードは投影座標 node_xy (K, 2)、辺の重みは所要時間 (秒)。
+    forward[a, b] は a → b の所要時間、backward はその転置 (店舗へ向かう所要時間を店舗側から探索する用)。
+    """
+    def __init__(self, node_xy, forward, fingerprint):
+        self.node_xy = np.ascontiguousarray(node_xy, dtype=np.float64)
+        self.forward = forward.tocsr()
+        self.backward = forward.T.tocsr()
+        self.fingerprint = fingerprint
+        self._tree = cKDTree(self.node_xy)
+
+    @property
+    def n_nodes(self):
+        return len(self.node_xy)
+
+    @classmethod
+    def from_edges(cls, edges, fingerprint=None):
+        """道路の GeoDataFrame (投影座標系) から、線の端点をノードとしてグラフを作る。"""
+        geometry = edges.geometry.to_numpy()
+        start_xy = shapely.get_coordinates(shapely.get_point(geometry, 0))
+        end_xy = shapely.get_coordinates(shapely.get_point(geometry, -1))
+        endpoints = np.round(np.vstack([start_xy, end_xy]), ROAD_NODE_DECIMALS)
+        node_xy, node_of = np.unique(endpoints, axis=0, return_inverse=True)
+        node_of = node_of.reshape(-1)
+        u, v = node_of[:len(edges)], node_of[len(edges):]
+
+        seconds = np.maximum(shapely.length(geometry) / (_edge_speed_kmh(edges) / 3.6), ROAD_MIN_EDGE_SECONDS)
+        direction = _edge_direction(edges)
+        forward_edges = direction >= 0
+        backward_edges = direction <= 0
+        src = np.concatenate([u[forward_edges], v[backward_edges]])
+        dst = np.concatenate([v[forward_edges], u[backward_edges]])
+        weight = np.concatenate([seconds[forward_edges], seconds[backward_edges]])
+        # 同じノード間に複数の辺がある場合は最短のものを残す (csr_matrix は重複を合計してしまうため)
+        order = np.lexsort((weight, dst, src))
+        src, dst, weight = src[order], dst[order], weight[order]
+        first = np.ones(len(src), dtype=bool)
+        first[1:] = (src[1:] != src[:-1]) | (dst[1:] != dst[:-1])
+        forward = sparse.csr_matrix((weight[first], (src[first], dst[first])), shape=(len(node_xy), len(node_xy)))
+        print(f"Road graph: {len(node_xy):,} nodes, {int(first.sum()):,} directed edges from {len(edges):,} road segments.")
+        return cls(node_xy, forward, fingerprint)
+
+    @classmethod
+    def from_file(cls, path, target_projected_crs=TARGET_CRS_PROJECTED, layer=None):
+        """GeoPackage / OSM PBF から道路グラフを作る。fingerprint は (ファイル, サイズ, 更新時刻, 速度設定)。"""
+        path = Path(path)
+        stat = path.stat()
+        fingerprint = {
+            'file': path.name, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'layer': layer,
+            'crs': str(target_projected_crs), 'speeds': ROAD_SPEED_KMH, 'default_speed': ROAD_DEFAULT_SPEED_KMH,
+        }
+        return cls.from_edges(read_road_edges(path, target_projected_crs, layer=layer), fingerprint=fingerprint)
+
+    def snap(self, xy):
+        """点 (N, 2) を最寄りノードにスナップする。返り値: (node (N,), スナップ距離 (N,) [m])。"""
+        distance, node = self._tree.query(np.asarray(xy, dtype=np.float64).reshape(-1, 2))
+        return node.astype(np.int64), distance
+
+
+class RoadNetworkIndex:
+    """
+    需要メッシュに対する道路所要時間の近傍インデックス (MeshSpatialIndex と同じインターフェース)。
+    「距離」は 最寄りノードまでのアクセス時間 + 道路上の最短所要時間 (秒) で、max_travel_time を超える組は持たない。
+    行 (起点ノード → 半径内メッシュと所要時間) は計算した分だけ保持し、save() で cache_dir に保存する。
+    """
+    def __init__(self, graph, mesh_xy, max_travel_time=MAX_TRAVEL_TIME_S, access_speed_kmh=ROAD_ACCESS_SPEED_KMH,
+                 cache_dir=None):
+        self.graph = graph
+        self.max_travel_time = float(max_travel_time)
+        self.access_speed = access_speed_kmh / 3.6 # m/s
+        mesh_xy = np.ascontiguousarray(mesh_xy, dtype=np.float64)
+        self.n_meshes = len(mesh_xy)
+        self.mesh_node, snap_distance = graph.snap(mesh_xy)
+        self.mesh_access = snap_distance / self.access_speed
+        self.rows = {} # 起点ノード → (mesh_idx, 店舗側アクセス時間を除いた所要時間)
+        self.n_sources_solved = 0
+        self.n_row_hits = 0
+        self._dirty = False
+        key_source = {
+            'format_version': ROAD_CACHE_FORMAT_VERSION, 'graph': graph.fingerprint,
+            'mesh': hashlib.sha256(mesh_xy.tobytes()).hexdigest(), 'max_travel_time': self.max_travel_time,
+            'access_speed_kmh': access_speed_kmh,
+        }
+        # 道路グラフ・メッシュ・上限が同じなら同じ値 (CaptureCache のキーにも使う)
+        self.fingerprint = hashlib.sha256(json.dumps(key_source, sort_keys=True).encode('utf-8')).hexdigest()[:20]
+        self.cache_path = None
+        if cache_dir is not None:
+            self.cache_path = Path(cache_dir) / f"road_times_{self.fingerprint}.npz"
+            self._load()
+
+    @classmethod
+    def from_file(cls, path, demand_mesh_gdf, max_travel_time=MAX_TRAVEL_TIME_S,
+                  target_projected_crs=TARGET_CRS_PROJECTED, layer=None, cache_dir=None,
+                  access_speed_kmh=ROAD_ACCESS_SPEED_KMH):
+        """道路グラフのファイルと需要メッシュ (GeoDataFrame または MeshTable) からインデックスを作る。"""
+        mesh_xy, _ = _mesh_arrays(demand_mesh_gdf)
+        graph = RoadGraph.from_file(path, target_projected_crs, layer=layer)
+        return cls(graph, mesh_xy, max_travel_time, access_speed_kmh=access_speed_kmh, cache_dir=cache_dir)
+
+    def _load(self):
+        if not self.cache_path.is_file():
+            return
+        try:
+            with np.load(self.cache_path) as data:
+                nodes, indptr, mesh_idx, times = data['nodes'], data['indptr'], data['mesh_idx'], data['times']
+        except (OSError, ValueError, KeyError) as e:
+            print(f"  Warning: Could not read road travel-time cache {self.cache_path}: {e}. Recomputing.")
+            return
+        for k, node in enumerate(nodes):
+            self.rows[int(node)] = (mesh_idx[indptr[k]:indptr[k + 1]], times[indptr[k]:indptr[k + 1]])
+        print(f"  Loaded travel times for {len(nodes):,} source nodes from {self.cache_path}")
+
+    def save(self):
+        """計算済みの行を cache_dir に保存する (新しく計算した行がなければ何もしない)。"""
+        if self.cache_path is None or not self._dirty:
+            return
+        nodes = np.array(sorted(self.rows), dtype=np.int64)
+        counts = np.array([len(self.rows[node][0]) for node in nodes], dtype=np.int64)
+        indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix='.road_times_', suffix='.npz', dir=self.cache_path.parent)
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, nodes=nodes, indptr=indptr,
+                     mesh_idx=np.concatenate([self.rows[node][0] for node in nodes]) if len(nodes) else np.empty(0, np.int64),
+                     times=np.concatenate([self.rows[node][1] for node in nodes]) if len(nodes) else np.empty(0))
+        os.replace(tmp_path, self.cache_path)
+        self._dirty = False
+        print(f"  Saved travel times for {len(nodes):,} source nodes ({int(indptr[-1]):,} pairs) to {self.cache_path}")
+
+    def _solve(self, nodes):
+        """
+        まだ行のない起点ノードについて、逆向きグラフ上で max_travel_time までの多始点 Dijkstra を解く。
+        (始点数 × ノード数) の結果配列が ROAD_DIJKSTRA_BYTES に収まるよう始点をまとめて解く。
+        """
+        missing = np.array(sorted({int(node) for node in nodes} - self.rows.keys()), dtype=np.int64)
+        self.n_row_hits += len(set(int(node) for node in nodes)) - len(missing)
+        if len(missing) == 0:
+            return
+        start = time.perf_counter()
+        batch = max(1, ROAD_DIJKSTRA_BYTES // (8 * max(self.graph.n_nodes, self.n_meshes)))
+        for lo in range(0, len(missing), batch):
+            sources = missing[lo:lo + batch]
+            node_times = csgraph.dijkstra(self.graph.backward, directed=True, indices=sources,
+                                          limit=self.max_travel_time)
+            mesh_times = node_times[:, self.mesh_node] + self.mesh_access
+            for k, node in enumerate(sources):
+                mesh_idx = np.flatnonzero(mesh_times[k] <= self.max_travel_time)
+                self.rows[int(node)] = (mesh_idx, mesh_times[k, mesh_idx])
+        self.n_sources_solved += len(missing)
+        self._dirty = True
+        print(f"  Solved bounded Dijkstra from {len(missing):,} source nodes "
+              f"(limit {self.max_travel_time:.0f} s) in {time.perf_counter() - start:.2f} s.")
+
+    def prepare(self, store_xy):
+        """店舗・候補地の座標 (M, 2) が使う起点ノードの行をまとめて計算しておく (貪欲法の 1 件ずつの問い合わせを避ける)。"""
+        store_node, _ = self.graph.snap(np.ascontiguousarray(store_xy, dtype=np.float64).reshape(-1, 2))
+        self._solve(store_node)
+
+    def _check_radius(self, radius):
+        if radius > self.max_travel_time + 1e-9:
+            raise ValueError(f"Travel-time cutoff {radius} s exceeds the index limit {self.max_travel_time} s; "
+                             "rebuild RoadNetworkIndex with a larger max_travel_time.")
+
+    def query_radius(self, x, y, radius):
+        """
+        点 (x, y) へ 0 < 所要時間 <= radius (秒) で到達できるメッシュを検索する。
+        返り値: (mesh_idx, travel_times) ※ mesh_idx は昇順
+        """
+        self._check_radius(radius)
+        node, snap_distance = self.graph.snap([[x, y]])
+        self._solve(node)
+        mesh_idx, times = self.rows[int(node[0])]
+        times = times + snap_distance[0] / self.access_speed
+        within = (times > 0) & (times <= radius)
+        return mesh_idx[within], times[within]
+
+    def neighbourhood(self, store_xy, max_distance):
+        """店舗座標 (M, 2) に対して 0 < 所要時間 <= max_distance (秒) のメッシュ × 店舗 近傍行列 (CSR) を作成する。"""
+        self._check_radius(max_distance)
+        store_xy = np.ascontiguousarray(store_xy, dtype=np.float64).reshape(-1, 2)
+        store_node, snap_distance = self.graph.snap(store_xy)
+        self._solve(store_node)
+        mesh_parts, store_parts, time_parts = [], [], []
+        for j, node in enumerate(store_node):
+            mesh_idx, times = self.rows[int(node)]
+            times = times + snap_distance[j] / self.access_speed
+            within = (times > 0) & (times <= max_distance)
+            mesh_parts.append(mesh_idx[within])
+            store_parts.append(np.full(int(within.sum()), j, dtype=np.intp))
+            time_parts.append(times[within])
+        if mesh_parts:
+            mesh_idx, store_idx, times = np.concatenate(mesh_parts), np.concatenate(store_parts), np.concatenate(time_parts)
+        else:
+            mesh_idx = store_idx = np.empty(0, dtype=np.intp)
+            times = np.empty(0, dtype=np.float64)
+        return NeighbourhoodMatrix.from_pairs(mesh_idx, store_idx, times, self.n_meshes, len(store_xy))
@@ -0,0 +1,85 @@
+"""
+greedy_new_store_selection の回帰テスト。method='full' (候補地ごとに全体を再計算) を基準として、
+'incremental' (差分評価) と 'lazy' (差分評価 + CELF の上界による枝刈り) が同じ候補地を同じ順に選び、
+店舗別需要も一致することを、最低需要 min_demand_per_store の有無それぞれで確かめる。
+共有メモリ上の並列評価 (n_workers > 1) についても、シングルプロセスとの一致と共有メモリの解放を確かめる。
+
+使い方:
+    python -m pytest sample/test_greedy_selection.py
+"""
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+from shapely.geometry import Point
+
+import benchmark
+import code1
+
+DISTANCE_DECAY = 2.0
+MAX_DISTANCE = 1500
+N_NEW_STORES = 6
+# 6 店目の選択が変わる最低需要 (最低需要なしでは cand_25、この値では cand_25 が下回って cand_11 になる)
+MIN_DEMAND = 12000
+
+
+def _points(rows, crs=code1.TARGET_CRS_PROJECTED):
+    """(id, x, y) と追加の列の dict から GeoDataFrame を作る。"""
+    return gpd.GeoDataFrame({key: [r[key] for r in rows] for key in rows[0] if key not in ('x', 'y')},
+                            geometry=[Point(r['x'], r['y']) for r in rows], crs=crs)
+
+@pytest.fixture(scope='module')
+def scenario():
+    """合成 250m メッシュ 625 個と、その範囲の候補地 30 か所・既存店 4 店 (自店 1, 競合 3)。"""
+    mesh_ids, population = benchmark.synthetic_mesh_population(625, seed=4)
+    demand_mesh = benchmark._silently(benchmark._build_demand_mesh, mesh_ids, population)
+    centers = gpd.GeoSeries(demand_mesh['center_point'])
+    lo = np.array([centers.x.min(), centers.y.min()])
+    hi = np.array([centers.x.max(), centers.y.max()])
+    rng = np.random.default_rng(5)
+    candidate_xy = rng.uniform(lo, hi, size=(30, 2))
+    store_xy = rng.uniform(lo, hi, size=(4, 2))
+    candidates = _points([{'id': f"cand_{k}", 'x': x, 'y': y} for k, (x, y) in enumerate(candidate_xy)])
+    existing = _points([{'id': f"ex_{k}", 'x': x, 'y': y, 'type': 'self' if k == 0 else 'comp',
+                         'attractiveness': 1.0 + k % 2} for k, (x, y) in enumerate(store_xy)])
+    return demand_mesh, candidates, existing
+
+def _select(scenario, method, min_demand_per_store, **kwargs):
+    demand_mesh, candidates, existing = scenario
+    selected, store_demand = benchmark._silently(
+        code1.greedy_new_store_selection, candidates, demand_mesh, existing, N_NEW_STORES, DISTANCE_DECAY,
+        MAX_DISTANCE, min_demand_per_store=min_demand_per_store, method=method, **kwargs)
+    return list(selected['id']), store_demand.set_index('store_id')['total_demand'].sort_index()
+
+@pytest.mark.parametrize('min_demand', [0, MIN_DEMAND])
+def test_methods_pick_the_same_stores(scenario, min_demand):
+    full_ids, full_demand = _select(scenario, 'full', min_demand)
+    assert len(full_ids) == N_NEW_STORES
+    for method in ('incremental', 'lazy'):
+        ids, demand = _select(scenario, method, min_demand)
+        assert ids == full_ids, method
+        assert list(demand.index) == list(full_demand.index), method
+        np.testing.assert_allclose(demand.to_numpy(), full_demand.to_numpy(), rtol=1e-9, err_msg=method)
+
+def test_min_demand_changes_the_selection(scenario):
+    """MIN_DEMAND で実際に選択が変わる (上のテストが最低需要による除外と上界の枝刈りを通っていることの確認)。"""
+    assert _select(scenario, 'full', 0)[0] != _select(scenario, 'full', MIN_DEMAND)[0]
+
+def _shared_memory_segments():
+    shm_dir = Path('/dev/shm')
+    return {path.name for path in shm_dir.iterdir()} if shm_dir.is_dir() else set()
+
+@pytest.mark.parametrize('min_demand', [0, MIN_DEMAND])
+def test_parallel_evaluation_matches_serial(scenario, min_demand):
+    """
+    共有メモリ上の並列評価 (n_workers=2) がシングルプロセスと同じ選択・需要になり、共有メモリを残さない。
+    chunk_size は候補地数 30 を割り切らない奇数にして、チャンクの境界と最後の半端なチャンクを通す。
+    """
+    before = _shared_memory_segments()
+    serial_ids, serial_demand = _select(scenario, 'incremental', min_demand, n_workers=1)
+    parallel_ids, parallel_demand = _select(scenario, 'incremental', min_demand, n_workers=2, chunk_size=7)
+    assert parallel_ids == serial_ids
+    np.testing.assert_array_equal(parallel_demand.to_numpy(), serial_demand.to_numpy())
+    assert _shared_memory_segments() - before == set()
@@ -0,0 +1,86 @@
+"""
+calculate_demand_capture (配列エンジン huff_capture_arrays) の回帰テスト。
+メッシュ × 店舗 の素朴な二重ループで計算したハフモデルの結果と、空間インデックスの有無それぞれで一致することを確かめる。
+
+使い方:
+    python -m pytest sample/test_huff_capture.py
+"""
+import math
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+from shapely.geometry import Point
+
+import code1
+
+DISTANCE_DECAY = 2.0
+MAX_DISTANCE = 2000.0
+
+
+def _demand_mesh(mesh_xy, population):
+    """中心点 (投影座標) と人口から calculate_demand_capture 用の需要メッシュを作る。"""
+    centers = [Point(x, y) for x, y in mesh_xy]
+    return gpd.GeoDataFrame({'mesh_id': [f"m{k}" for k in range(len(mesh_xy))], 'population': population,
+                             'center_point': gpd.GeoSeries(centers, crs=code1.TARGET_CRS_PROJECTED)},
+                            geometry=centers, crs=code1.TARGET_CRS_PROJECTED)
+
+def _stores(rows):
+    """(store_id, type, x, y, attractiveness) のリストから店舗の GeoDataFrame を作る。"""
+    return gpd.GeoDataFrame(
+        {'store_id': [r[0] for r in rows], 'type': [r[1] for r in rows], 'attractiveness': [r[4] for r in rows]},
+        geometry=[Point(r[2], r[3]) for r in rows], crs=code1.TARGET_CRS_PROJECTED
+    )
+
+def _naive_store_totals(mesh_xy, population, rows):
+    """従来の iterrows 版と同じ考え方の二重ループ (0 < 距離 <= MAX_DISTANCE の店舗だけが引力を持つ)。"""
+    totals = {r[0]: 0.0 for r in rows}
+    for (mx, my), pop in zip(mesh_xy, population):
+        attraction = {}
+        for store_id, _, sx, sy, attr in rows:
+            distance = math.hypot(mx - sx, my - sy)
+            if 0 < distance <= MAX_DISTANCE:
+                attraction[store_id] = attr / distance ** DISTANCE_DECAY
+        total = sum(attraction.values())
+        for store_id, value in attraction.items():
+            totals[store_id] += pop * value / total
+    return totals
+
+@pytest.fixture
+def scenario():
+    """250m 間隔の 13 × 13 の格子と、境界条件を含む店舗 4 店。"""
+    grid = np.arange(13) * 250.0
+    mesh_xy = np.array([(x, y) for y in grid for x in grid])
+    population = np.random.default_rng(0).integers(1, 500, len(mesh_xy)).astype(np.float64)
+    rows = [
+        ('on_centre', 'self', 0.0, 0.0, 1.0),      # メッシュ (0, 0) の中心上: そのメッシュには距離 0 で含めない
+        ('at_cutoff', 'comp', 3000.0, 1000.0, 2.0), # メッシュ (1000, 1000) とちょうど MAX_DISTANCE
+        ('inside', 'self', 1630.0, 1410.0, 1.5),
+        ('far', 'comp', 9000.0, 9000.0, 1.0),        # どのメッシュにも届かない
+    ]
+    return mesh_xy, population, rows
+
+@pytest.mark.parametrize('use_index', [False, True])
+def test_capture_matches_naive_double_loop(scenario, use_index):
+    mesh_xy, population, rows = scenario
+    demand_mesh = _demand_mesh(mesh_xy, population)
+    spatial_index = code1.MeshSpatialIndex.from_mesh(demand_mesh, MAX_DISTANCE) if use_index else None
+    capture_df, store_total_demand = code1.calculate_demand_capture(
+        demand_mesh, _stores(rows), DISTANCE_DECAY, MAX_DISTANCE, spatial_index=spatial_index)
+
+    expected = _naive_store_totals(mesh_xy, population, rows)
+    actual = store_total_demand.set_index('store_id')['total_demand']
+    assert set(actual.index) == {store_id for store_id, value in expected.items() if value > 0}
+    for store_id, value in actual.items():
+        assert value == pytest.approx(expected[store_id], rel=1e-9)
+
+    pairs = set(zip(capture_df['mesh_id'], capture_df['store_id']))
+    assert ('m0', 'on_centre') not in pairs
+    assert ('m1', 'on_centre') in pairs
+    assert (f"m{4 * 13 + 4}", 'at_cutoff') in pairs # (1000, 1000) は距離ちょうど 2000
+    assert 'far' not in set(capture_df['store_id'])
+    # 各メッシュの獲得割合の合計は 1 (引力を持つ店舗があるメッシュのみ)
+    ratio_sum = capture_df.groupby('mesh_id')['capture_ratio'].sum()
+    np.testing.assert_allclose(ratio_sum.to_numpy(), 1.0, rtol=1e-12)
+    assert capture_df['captured_demand'].sum() == pytest.approx(pd.Series(expected).sum(), rel=1e-9)
@@ -0,0 +1,98 @@
+"""
+HuffModelState.apply_changes の回帰テスト。増分再計算の結果が from_stores で全体を作り直した場合と一致すること、
+不正な入力では状態を変えずに ValueError になることを確かめる。
+
+使い方:
+    python -m pytest sample/test_huff_model_state.py
+"""
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+from shapely.geometry import Point
+
+import benchmark
+import code1
+
+DISTANCE_DECAY = 2.0
+MAX_DISTANCE = 2000
+
+
+def _demand_mesh(mesh_ids, population):
+    return benchmark._silently(benchmark._build_demand_mesh, np.asarray(mesh_ids), np.asarray(population, dtype=np.float64))
+
+def _stores(rows):
+    """(id, type, x, y, attractiveness) のリストから店舗の GeoDataFrame を作る。"""
+    return gpd.GeoDataFrame(
+        {'id': [r[0] for r in rows], 'type': [r[1] for r in rows], 'attractiveness': [r[4] for r in rows]},
+        geometry=[Point(r[2], r[3]) for r in rows], crs=code1.TARGET_CRS_PROJECTED
+    )
+
+@pytest.fixture
+def scenario():
+    """合成 250m メッシュ 900 個と店舗 10 店。先頭 850 メッシュ・8 店で状態を作り、残りは後から追加する。"""
+    mesh_ids, population = benchmark.synthetic_mesh_population(900, seed=1)
+    mesh_gdf = _demand_mesh(mesh_ids, population)
+    centers = gpd.GeoSeries(mesh_gdf['center_point'])
+    xy = np.column_stack([centers.x.to_numpy(), centers.y.to_numpy()])
+    rng = np.random.default_rng(2)
+    picks = rng.choice(850, size=10, replace=False)
+    rows = [(f"s{k}", 'self' if k % 3 == 0 else 'comp', xy[p, 0] + 30, xy[p, 1] - 40, 1.0 + k % 2)
+            for k, p in enumerate(picks)]
+    return mesh_ids, population, rows
+
+def _assert_matches(state, reference):
+    order = pd.Index(reference.store_ids).get_indexer(state.store_ids)
+    assert (order >= 0).all() and len(order) == reference.n_stores
+    np.testing.assert_array_equal(state.mesh_ids, reference.mesh_ids)
+    np.testing.assert_allclose(state.mesh_pop, reference.mesh_pop)
+    np.testing.assert_allclose(state.attraction.total_attraction, reference.attraction.total_attraction, rtol=1e-12)
+    np.testing.assert_allclose(state.attraction.self_attraction, reference.attraction.self_attraction, rtol=1e-12)
+    np.testing.assert_allclose(state.store_total, reference.store_total[order], rtol=1e-9, atol=1e-9)
+    assert state.self_demand() == pytest.approx(reference.self_demand(), rel=1e-12)
+
+def test_combined_changes_match_full_rebuild(scenario, tmp_path):
+    mesh_ids, population, rows = scenario
+    state = code1.HuffModelState.from_stores(_demand_mesh(mesh_ids[:850], population[:850]), _stores(rows[:8]),
+                                             DISTANCE_DECAY, MAX_DISTANCE)
+    path = tmp_path / 'state.npz'
+    state.save(path)
+    state = code1.HuffModelState.load(path)
+
+    new_population = population.copy()
+    new_population[[5, 120, 400]] = [0.0, 999.0, 12.0]
+    changes = pd.Series(new_population[list(range(850)) + list(range(850, 900))],
+                        index=list(mesh_ids[:850]) + list(mesh_ids[850:]))
+    report = state.apply_changes(mesh_population=changes, added_stores=_stores(rows[8:]),
+                                 removed_store_ids=['s1', 's4'])
+
+    kept_rows = [r for r in rows if r[0] not in ('s1', 's4')]
+    reference = code1.HuffModelState.from_stores(_demand_mesh(mesh_ids, new_population), _stores(kept_rows),
+                                                 DISTANCE_DECAY, MAX_DISTANCE)
+    _assert_matches(state, reference)
+    assert {'s1', 's4', 's8', 's9'} <= set(report['store_id'])
+    assert report.loc[report['store_id'] == 's1', 'after'].item() == 0.0
+
+def test_invalid_changes_leave_state_untouched(scenario):
+    mesh_ids, population, rows = scenario
+    state = code1.HuffModelState.from_stores(_demand_mesh(mesh_ids[:850], population[:850]), _stores(rows[:8]),
+                                             DISTANCE_DECAY, MAX_DISTANCE)
+    reference = code1.HuffModelState.from_stores(_demand_mesh(mesh_ids[:850], population[:850]), _stores(rows[:8]),
+                                                 DISTANCE_DECAY, MAX_DISTANCE)
+    changed_population = pd.Series([7.0], index=[mesh_ids[3]])
+    invalid_changes = [
+        dict(removed_store_ids=['s0'], added_stores=_stores([rows[2]])),           # 既存と重複する ID
+        dict(removed_store_ids=['s0'], added_stores=_stores([rows[8], rows[8]])),  # 追加どうしで重複する ID
+        dict(removed_store_ids=['s0', 'nope']),                                    # 未知の削除 ID
+        dict(removed_store_ids=['s0'], added_stores=_stores([rows[8]]).drop(columns='attractiveness')),
+        dict(removed_store_ids=['s0'], mesh_population=pd.concat(
+            [changed_population, pd.Series([1.0], index=['5339999999'])])),       # 無効な新メッシュコード
+    ]
+    for changes in invalid_changes:
+        with pytest.raises(ValueError):
+            state.apply_changes(**changes)
+        _assert_matches(state, reference)
+
+    # 削除した店舗の ID は同じ呼び出しで追加し直せる
+    state.apply_changes(removed_store_ids=['s0'], added_stores=_stores([rows[0]]))
+    _assert_matches(state, reference)
@@ -0,0 +1,152 @@
+"""
+huff_service (what-if 評価の常駐 HTTP サービス) の回帰テスト。
+合成メッシュのモデルで HuffService を空いているポートに立て、/stores/add と /greedy (commit) を並行に送っても
+各応答がそれぞれ自分のスナップショット (直前の店舗集合 + 自分が加えた店舗) を表していること、
+ID の重複は 400 で拒否されて 500 にならないこと、不正なリクエストへの応答を確かめる。
+
+使い方:
+    python -m pytest sample/test_huff_service.py
+"""
+import asyncio
+import json
+from http import HTTPStatus
+
+import numpy as np
+import pytest
+
+import benchmark
+import huff_service
+
+N_MESHES = 2000
+N_WORKERS = 4
+N_CLIENTS = 8
+REQUESTS_PER_CLIENT = 3
+
+
+@pytest.fixture(scope='module')
+def model(tmp_path_factory):
+    """合成 250m メッシュ 2000 個、ダミーの候補地 100 か所・既存店 5 店のモデル。"""
+    np.random.seed(0) # ダミー候補地・既存店の生成を再現できるように
+    config = huff_service._synthetic_config(N_MESHES, tmp_path_factory.mktemp('estat') / '250mesh', seed=0)
+    return benchmark._silently(huff_service.WhatIfModel.from_config, config)
+
+def _run_with_service(model, scenario):
+    """サービスを 127.0.0.1 の空いているポートで起動し、scenario(port) を実行して結果を返す。"""
+    async def run():
+        service = huff_service.HuffService(model, n_workers=N_WORKERS)
+        server = await service.start('127.0.0.1', 0)
+        try:
+            return await scenario(server.sockets[0].getsockname()[1])
+        finally:
+            server.close()
+            await server.wait_closed()
+            service.close()
+    return asyncio.run(run())
+
+async def _request(port, method, path, payload=None):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        return await huff_service.request_json(reader, writer, method, path, payload)
+    finally:
+        writer.close()
+
+async def _request_raw(port, method, path, body):
+    """JSON として送れない本文をそのまま送る。返り値: (ステータス, JSON)。"""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    try:
+        writer.write((f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(body)}\r\n"
+                      "Connection: close\r\n\r\n").encode('latin-1') + body)
+        await writer.drain()
+        status_line, _, data = (await reader.read()).partition(b'\r\n\r\n')
+        return int(status_line.split()[1]), (json.loads(data) if data else None)
+    finally:
+        writer.close()
+
+def _site(rng, lo, hi, **extra):
+    x, y = rng.uniform(lo, hi)
+    return {'x': float(x), 'y': float(y), **extra}
+
+def test_concurrent_writes_reply_with_their_own_snapshot(model):
+    rng = np.random.default_rng(1)
+    lo, hi = model.mesh_xy.min(axis=0), model.mesh_xy.max(axis=0)
+
+    async def client(port, worker):
+        replies = []
+        for k in range(REQUESTS_PER_CLIENT):
+            if worker % 2 == 0: # ID を指定した店舗と、ID を省略した (サービス側で振る) 店舗を1店ずつ
+                stores = [_site(rng, lo, hi, id=f"add_{worker}_{k}", type='comp'), _site(rng, lo, hi)]
+                status, result = await _request(port, 'POST', '/stores/add', {'stores': stores})
+                replies.append(('add', status, result, stores[0]['id']))
+            else:
+                status, result = await _request(port, 'POST', '/greedy', {'n_new_stores': 1 + k % 2, 'commit': True})
+                replies.append(('greedy', status, result, None))
+        return replies
+
+    async def scenario(port):
+        _, initial = await _request(port, 'GET', '/stores')
+        duplicate = {'stores': [_site(rng, lo, hi, id='same_id')]}
+        results = await asyncio.gather(*(client(port, worker) for worker in range(N_CLIENTS)),
+                                       _request(port, 'POST', '/stores/add', duplicate),
+                                       _request(port, 'POST', '/stores/add', duplicate))
+        _, final = await _request(port, 'GET', '/stores')
+        return initial, [reply for replies in results[:N_CLIENTS] for reply in replies], results[N_CLIENTS:], final
+
+    initial, replies, duplicate_replies, final = _run_with_service(model, scenario)
+
+    # 同じ ID の同時追加は片方だけが通り、もう片方は 400
+    assert sorted(status for status, _ in duplicate_replies) == [HTTPStatus.OK, HTTPStatus.BAD_REQUEST]
+    assert all(status == HTTPStatus.OK for _, status, _, _ in replies), [r for r in replies if r[1] != HTTPStatus.OK]
+
+    # 各応答の店舗集合 (snapshot)、その応答で加わった店舗、貪欲法が選択に使った状態の自チェーン需要
+    snapshots = [(initial, [], None)]
+    for kind, _, result, store_id in replies:
+        if kind == 'add':
+            added = [store['id'] for store in result['stores'][-2:]]
+            assert added[0] == store_id and added[1].startswith('whatif_')
+            snapshots.append((result, added, None))
+        else:
+            assert len(result['selected']) >= 1
+            # 選択に使った状態と加えた後の状態が同じ (選んでから加えるまでに他の更新が入っていない)
+            assert result['self_demand'] == pytest.approx(result['stores']['self_demand'], rel=1e-9)
+            snapshots.append((result['stores'], result['selected'], result['base_self_demand']))
+    duplicate_snapshot = next(result for status, result in duplicate_replies if status == HTTPStatus.OK)
+    snapshots.append((duplicate_snapshot, ['same_id'], None))
+
+    # 更新は直列に並ぶ: 店舗数の順に並べると、どの応答も直前の応答の店舗集合に自分の店舗を加えたものになる
+    snapshots.sort(key=lambda item: item[0]['n_stores'])
+    for (previous, _, _), (current, added, base_self_demand) in zip(snapshots, snapshots[1:]):
+        previous_ids = [store['id'] for store in previous['stores']]
+        assert [store['id'] for store in current['stores']] == previous_ids + added
+        assert current['removed'] == []
+        previous_demand = {store['id']: store['total_demand'] for store in previous['stores']}
+        for store in current['stores']:
+            before = store['total_demand'] - store['delta']
+            assert before == pytest.approx(previous_demand.get(store['id'], 0.0), rel=1e-9, abs=1e-6)
+        if base_self_demand is not None: # 貪欲法は直前の店舗集合から選んでいる
+            assert base_self_demand == pytest.approx(previous['self_demand'], rel=1e-9)
+
+    assert [store['id'] for store in final['stores']] == [store['id'] for store in snapshots[-1][0]['stores']]
+    all_ids = [store['id'] for store in final['stores']]
+    assert len(all_ids) == len(set(all_ids))
+
+def test_bad_requests_are_rejected(model):
+    async def scenario(port):
+        return {
+            'malformed': await _request_raw(port, 'POST', '/score', b'{"sites": ['),
+            'not_object': await _request_raw(port, 'POST', '/score', b'[1, 2]'),
+            'bad_site': await _request(port, 'POST', '/score', {'sites': [{'x': 1.0}]}),
+            'bad_request_line': await _request_raw(port, 'POST', '/score HTTP/1.1 extra', b''),
+            'unknown_path': await _request(port, 'POST', '/nope', {}),
+            'wrong_method': await _request(port, 'GET', '/score'),
+            'health': await _request(port, 'GET', '/health'),
+        }
+
+    replies = _run_with_service(model, scenario)
+    for name in ('malformed', 'not_object', 'bad_site', 'bad_request_line'):
+        status, result = replies[name]
+        assert status == HTTPStatus.BAD_REQUEST, name
+        assert result['error'], name
+    assert 'JSON object' in replies['not_object'][1]['error']
+    assert replies['unknown_path'][0] == HTTPStatus.NOT_FOUND
+    assert replies['wrong_method'][0] == HTTPStatus.METHOD_NOT_ALLOWED
+    assert replies['health'] == (HTTPStatus.OK, {'status': 'ok', 'n_meshes': model.n_meshes})
@@ -0,0 +1,126 @@
+"""
+road_network (道路所要時間の近傍インデックス) の回帰テスト。
+100m 間隔・10 × 10 交差点の格子状の住宅道路 (20 km/h で 1 区間 18 秒) を GeoPackage に書き、
+所要時間がマンハッタン距離どおりになること、店舗へ向かう向き (逆向きグラフ) で探索していること、
+一方通行 ('yes' / '-1') の扱い、所要時間 0 の組を含めないこと、cache_dir への保存と再読み込みを確かめる。
+
+使い方:
+    python -m pytest sample/test_road_network.py
+"""
+import geopandas as gpd
+import numpy as np
+import pytest
+from shapely.geometry import LineString
+
+import benchmark
+import code1
+import road_network
+
+BLOCK_M = 100.0
+BLOCK_S = BLOCK_M / (road_network.ROAD_SPEED_KMH['residential'] / 3.6) # 18 秒
+ACCESS_S_PER_M = 1 / (road_network.ROAD_ACCESS_SPEED_KMH / 3.6)         # 10 km/h で 1m あたり 0.36 秒
+N_NODES = 10
+MAX_TRAVEL_TIME = 600
+
+
+def _grid_edges(oneway=None):
+    """
+    交差点で分割した格子の道路 (左下 → 右上の向きに線を引く)。
+    oneway は ((x0, y0), (x1, y1)) → (線の向き, oneway の値) の dict で、指定した区間だけ一方通行にする。
+    """
+    oneway = oneway or {}
+    lines, flags = [], []
+    for i in range(N_NODES):
+        for j in range(N_NODES):
+            for a, b in (((i, j), (i + 1, j)), ((i, j), (i, j + 1))):
+                if max(b) >= N_NODES:
+                    continue
+                line, flag = oneway.get((a, b), ((a, b), 'False'))
+                lines.append(LineString([(x * BLOCK_M, y * BLOCK_M) for x, y in line]))
+                flags.append(flag)
+    return gpd.GeoDataFrame({'highway': 'residential', 'oneway': flags}, geometry=lines,
+                            crs=code1.TARGET_CRS_PROJECTED)
+
+def _graph(tmp_path, oneway=None):
+    path = tmp_path / 'roads.gpkg'
+    _grid_edges(oneway).to_file(path, layer='edges', driver='GPKG')
+    return benchmark._silently(road_network.RoadGraph.from_file, path)
+
+def _node_meshes():
+    """各交差点上のメッシュ中心 (スナップ距離 0)。インデックスは i + N_NODES * j。"""
+    grid = np.arange(N_NODES) * BLOCK_M
+    return np.array([(x, y) for y in grid for x in grid])
+
+def _times_to(index, x, y, radius=MAX_TRAVEL_TIME):
+    mesh_idx, times = benchmark._silently(index.query_radius, x, y, radius)
+    return dict(zip(mesh_idx.tolist(), times.tolist()))
+
+def test_travel_times_follow_the_street_grid(tmp_path):
+    # 交差点上のメッシュ 100 個と、(300, 0) から北に 20m ずれたメッシュ (アクセス 7.2 秒)
+    mesh_xy = np.vstack([_node_meshes(), [[3 * BLOCK_M, 20.0]]])
+    index = road_network.RoadNetworkIndex(_graph(tmp_path), mesh_xy, MAX_TRAVEL_TIME)
+    times = _times_to(index, 0.0, 0.0)
+
+    assert times[9 + N_NODES * 1] == pytest.approx(180.0)      # 10 区間
+    assert times[2 + N_NODES * 1] == pytest.approx(54.0)       # 3 区間
+    assert times[len(mesh_xy) - 1] == pytest.approx(54.0 + 7.2)
+    assert 0 not in times # 店舗と同じノード上のメッシュ (所要時間 0) は含めない
+    expected = {i + N_NODES * j: (i + j) * BLOCK_S for j in range(N_NODES) for i in range(N_NODES) if i + j > 0}
+    assert set(times) == set(expected) | {len(mesh_xy) - 1}
+    for mesh, seconds in expected.items():
+        assert times[mesh] == pytest.approx(seconds)
+
+    # 半径での絞り込みと、店舗側のスナップ距離 (15m) も所要時間に加わること
+    assert set(_times_to(index, 0.0, 0.0, radius=2.5 * BLOCK_S)) == {1, 2, N_NODES, N_NODES + 1, 2 * N_NODES}
+    offset = _times_to(index, 5 * BLOCK_M, 5 * BLOCK_M + 15.0)
+    assert offset[5 + N_NODES * 5] == pytest.approx(15.0 * ACCESS_S_PER_M)
+    assert offset[6 + N_NODES * 5] == pytest.approx(BLOCK_S + 15.0 * ACCESS_S_PER_M)
+
+    with pytest.raises(ValueError):
+        index.query_radius(0.0, 0.0, MAX_TRAVEL_TIME + 1)
+
+def test_one_way_streets_are_searched_towards_the_store(tmp_path):
+    """
+    一方通行は メッシュ → 店舗 の向きで効く。(0,0) → (1,0) は線の向きのみ ('yes')、
+    (9,0) → (8,0) に引いた線は逆向きのみ ('-1') なので (8,0) → (9,0) だけ通れる。通れない向きは 1 ブロック迂回する。
+    """
+    oneway = {((0, 0), (1, 0)): (((0, 0), (1, 0)), 'yes'),
+              ((8, 0), (9, 0)): (((9, 0), (8, 0)), '-1')}
+    index = road_network.RoadNetworkIndex(_graph(tmp_path, oneway), _node_meshes(), MAX_TRAVEL_TIME)
+
+    assert _times_to(index, 1 * BLOCK_M, 0.0)[0] == pytest.approx(BLOCK_S)         # (0,0) から (1,0) の店舗へ
+    assert _times_to(index, 0.0, 0.0)[1] == pytest.approx(3 * BLOCK_S)             # (1,0) から (0,0) へは迂回
+    assert _times_to(index, 9 * BLOCK_M, 0.0)[8] == pytest.approx(BLOCK_S)         # (8,0) から (9,0) の店舗へ
+    assert _times_to(index, 8 * BLOCK_M, 0.0)[9] == pytest.approx(3 * BLOCK_S)     # (9,0) から (8,0) へは迂回
+
+    # neighbourhood も query_radius と同じ向き・同じ所要時間になる
+    store_xy = np.array([[0.0, 0.0], [1 * BLOCK_M, 0.0]])
+    matrix = benchmark._silently(index.neighbourhood, store_xy, MAX_TRAVEL_TIME)
+    mesh_idx, store_idx, seconds = matrix.pairs()
+    for j, (x, y) in enumerate(store_xy):
+        expected = _times_to(index, x, y)
+        mine = store_idx == j
+        assert dict(zip(mesh_idx[mine].tolist(), seconds[mine].tolist())) == pytest.approx(expected)
+
+def test_cached_rows_round_trip(tmp_path):
+    graph = _graph(tmp_path)
+    cache_dir = tmp_path / 'cache'
+    store_xy = np.array([[0.0, 0.0], [4 * BLOCK_M, 7 * BLOCK_M + 30.0], [9 * BLOCK_M, 9 * BLOCK_M]])
+    first = road_network.RoadNetworkIndex(graph, _node_meshes(), MAX_TRAVEL_TIME, cache_dir=cache_dir)
+    benchmark._silently(first.prepare, store_xy)
+    assert first.n_sources_solved == 3
+    benchmark._silently(first.save)
+    assert first.cache_path.is_file()
+    expected = benchmark._silently(first.neighbourhood, store_xy, MAX_TRAVEL_TIME).pairs()
+
+    # 同じ道路グラフ・メッシュ・上限なら保存した行を読み、Dijkstra を解き直さない
+    second = road_network.RoadNetworkIndex(graph, _node_meshes(), MAX_TRAVEL_TIME, cache_dir=cache_dir)
+    assert second.fingerprint == first.fingerprint
+    actual = benchmark._silently(second.neighbourhood, store_xy, MAX_TRAVEL_TIME).pairs()
+    assert second.n_sources_solved == 0 and second.n_row_hits == 3
+    for a, b in zip(actual, expected):
+        np.testing.assert_array_equal(a, b)
+
+    # 上限が違えば別のキャッシュになる
+    other = road_network.RoadNetworkIndex(graph, _node_meshes(), MAX_TRAVEL_TIME / 2, cache_dir=cache_dir)
+    assert other.fingerprint != first.fingerprint and other.rows == {}